@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 CNRS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Offline benchmarks on synthetic annotations (no Camomile server needed)
+
+Usage:
+  benchmark store [options]
+  benchmark window [options]
+  benchmark consensus [options]
+
+Commands:
+  store                    robot_label_in refresh time (hypotheses and
+                           annotators of remaining shots) vs. number of
+                           shots, with and without shot-indexed store.
+  window                   robot_label_in "others" gathering time vs.
+                           --other window size, with and without
+                           sliding-window sweep.
+  consensus                robot_label_out consensus on random votes: checks
+                           that ShotVotes agrees with the former pandas
+                           DataFrame implementation, and times both.
+
+Options:
+  -h --help                Show this screen.
+  --shots=LIST             Comma-separated numbers of shots per medium
+                           [default: 100,500,1000,2000].
+  --votes=N                Number of label annotations per shot [default: 3].
+  --names=N                Number of distinct person names [default: 200].
+  --window=LIST            Comma-separated --other values (window command)
+                           [default: 2,10,50,100].
+  --samples=N              Number of random shots (consensus command)
+                           [default: 2000].
+  --repeat=N               Keep best of N runs [default: 3].
+"""
+
+from shots import ShotAnnotationStore, NameIndex, sliding_window_union
+from consensus import ShotVotes, UNKNOWN
+from docopt import docopt
+from pandas import DataFrame
+from tortilla.utils import bunchify
+import random
+import time
+
+
+def synthetic_label_annotations(nShots, nVotes, nNames):
+
+    names = ['person_{n:d}'.format(n=n) for n in range(nNames)]
+    statuses = ['speakingFace', 'noFace', 'dontKnow']
+
+    annotations = []
+    for shot in range(nShots):
+        for vote in range(nVotes):
+            known = {name: random.choice(statuses)
+                     for name in random.sample(names, 3)}
+            annotations.append({
+                'fragment': 'shot_{s:d}'.format(s=shot),
+                'data': {'known': known,
+                         'unknown': random.random() > 0.8,
+                         'annotator': 'user_{v:d}'.format(v=vote)}})
+
+    random.shuffle(annotations)
+    return bunchify(annotations)
+
+
+def best_of(repeat, func, *args):
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        func(*args)
+        durations.append(time.time() - start)
+    return min(durations)
+
+
+def refresh_scan(allAnnotations, remainingShots):
+    # one linear scan of all annotations per shot (previous approach)
+    hypotheses = {}
+    annotators = {}
+    for shot in remainingShots:
+        hypotheses[shot] = set([])
+        annotators[shot] = set([])
+        for annotation in [a for a in allAnnotations if a.fragment == shot]:
+            hypotheses[shot].update(
+                set(annotation.data.get('known', {}).keys()))
+            annotators[shot].add(annotation.data.annotator)
+    return hypotheses, annotators
+
+
+def refresh_store(allAnnotations, remainingShots):
+    # one indexing pass, then constant-time lookups per shot
+    allAnnotations = ShotAnnotationStore(allAnnotations)
+    hypotheses = {}
+    annotators = {}
+    for shot in remainingShots:
+        hypotheses[shot] = set(allAnnotations.known(shot))
+        annotators[shot] = set(allAnnotations.annotators(shot))
+    return hypotheses, annotators
+
+
+def benchmark_store(shots, votes, names, repeat):
+
+    print '{0:>8s} {1:>12s} {2:>12s} {3:>9s}'.format(
+        'shots', 'scan (s)', 'store (s)', 'speed-up')
+
+    for nShots in shots:
+
+        allAnnotations = synthetic_label_annotations(nShots, votes, names)
+        remainingShots = ['shot_{s:d}'.format(s=s) for s in range(nShots)]
+
+        assert (refresh_scan(allAnnotations, remainingShots) ==
+                refresh_store(allAnnotations, remainingShots))
+
+        scan = best_of(repeat, refresh_scan, allAnnotations, remainingShots)
+        store = best_of(repeat, refresh_store, allAnnotations, remainingShots)
+
+        print '{0:8d} {1:12.4f} {2:12.4f} {3:8.1f}x'.format(
+            nShots, scan, store, scan / store)
+
+
+def synthetic_shot_names(nShots, nNames):
+    names = ['person_{n:d}'.format(n=n) for n in range(nNames)]
+    return {'shot_{s:d}'.format(s=shot): set(random.sample(names, 2))
+            for shot in range(nShots)}
+
+
+def others_scan(sortedShots, shotNames, other):
+    # one list.index and up to 2 x other unions per shot (previous approach)
+    others = {}
+    n = len(sortedShots)
+    for shot in sortedShots:
+        others[shot] = set([])
+        i = sortedShots.index(shot)
+        for nearShot in sortedShots[max(i - other, 0):min(i + other, n)]:
+            others[shot].update(shotNames[nearShot])
+    return others
+
+
+def others_sweep(sortedShots, shotIDs, other):
+    # one sweep with a sliding multiset of interned names
+    return dict(sliding_window_union(
+        sortedShots, shotIDs.get, other, other))
+
+
+def benchmark_window(shots, others, names, repeat):
+
+    print '{0:>8s} {1:>6s} {2:>12s} {3:>12s} {4:>9s}'.format(
+        'shots', 'other', 'scan (s)', 'sweep (s)', 'speed-up')
+
+    for nShots in shots:
+
+        shotNames = synthetic_shot_names(nShots, names)
+        sortedShots = ['shot_{s:d}'.format(s=s) for s in range(nShots)]
+
+        # robot_label_in stores sets of names as sets of interned IDs
+        index = NameIndex()
+        shotIDs = {shot: index.ids(shotNames[shot])
+                   for shot in sortedShots}
+
+        for other in others:
+
+            swept = others_sweep(sortedShots, shotIDs, other)
+            assert others_scan(sortedShots, shotNames, other) == {
+                shot: set(index.names(ids))
+                for shot, ids in swept.iteritems()}
+
+            scan = best_of(repeat, others_scan,
+                           sortedShots, shotNames, other)
+            sweep = best_of(repeat, others_sweep,
+                            sortedShots, shotIDs, other)
+
+            print '{0:8d} {1:6d} {2:12.4f} {3:12.4f} {4:8.1f}x'.format(
+                nShots, other, scan, sweep, scan / sweep)
+
+
+def random_votes(nVotes):
+
+    # few annotators and person names, to get collisions and ties
+    annotators = ['user_{a:d}'.format(a=a) for a in range(nVotes)]
+    names = ['person_{n:d}'.format(n=n) for n in range(3)]
+    statuses = ['speakingFace', 'noFace', 'dontKnow']
+
+    return [{'annotator': random.choice(annotators),
+             'unknown': random.random() > 0.7,
+             'known': {name: random.choice(statuses)
+                       for name in random.sample(
+                           names, random.randint(0, len(names)))}}
+            for _ in range(random.randint(1, nVotes))]
+
+
+def consensus_dataframe(annotations):
+    # former robot_label_out implementation (without logging)
+    # returns (unknown, consensus, ambiguous) where ambiguous tells
+    # whether a tie between 'dontKnow' and another status was met
+
+    personNames = set([])
+    for data in annotations:
+        personNames.update(data.get('known', {}))
+
+    df = DataFrame(columns=personNames.union(set([UNKNOWN])))
+
+    for data in annotations:
+        annotator = data['annotator']
+        unknown = data['unknown']
+        df.at[annotator, UNKNOWN] = 'speakingFace' if unknown else 'noFace'
+        known = data.get('known', {})
+        for personName in personNames:
+            status = known.get(personName,
+                               'dontKnow' if unknown else 'noFace')
+            df.at[annotator, personName] = status
+
+    if df[UNKNOWN].value_counts().get('speakingFace', 0) > 0:
+        unknown = True
+    else:
+        unknown = False
+
+    if len(df) < 2:
+        return unknown, None, False
+
+    consensus = {}
+    ambiguous = False
+    for personName in df:
+        counts = df[personName].value_counts()
+        expressedCounts = sum(count for status, count in counts.iteritems()
+                              if status != 'dontKnow')
+        if expressedCounts < 2:
+            return unknown, None, False
+
+        # pandas breaks ties arbitrarily
+        ambiguous |= (counts.get('dontKnow', 0) == counts.max() and
+                      (counts == counts.max()).sum() > 1)
+
+        status = counts.idxmax()
+        if status == 'dontKnow':
+            return unknown, None, ambiguous
+        count = counts.max()
+        if count < 2:
+            return unknown, None, ambiguous
+        ratio = count / float(expressedCounts)
+        if ratio > 0.5:
+            consensus[personName] = status
+        else:
+            return unknown, None, ambiguous
+
+    return unknown, consensus, ambiguous
+
+
+def consensus_votes(annotations):
+    # current robot_label_out implementation
+    votes = ShotVotes(annotations)
+    return votes.has_unknown(), votes.consensus()[0]
+
+
+def benchmark_consensus(samples, votes, repeat):
+
+    shots = [random_votes(votes) for _ in range(samples)]
+
+    # same decisions, except when pandas arbitrarily breaks
+    # a tie between 'dontKnow' and another status
+    ambiguous = 0
+    for annotations in shots:
+        unknown, consensus, tie = consensus_dataframe(annotations)
+        if (unknown, consensus) != consensus_votes(annotations):
+            assert tie, annotations
+            ambiguous += 1
+
+    print '{0:d} shots, {1:d} with a consensus, {2:d} ambiguous ties'.format(
+        samples,
+        sum(1 for annotations in shots
+            if consensus_votes(annotations)[1] is not None),
+        ambiguous)
+
+    dataframe = best_of(repeat, lambda: map(consensus_dataframe, shots))
+    counter = best_of(repeat, lambda: map(consensus_votes, shots))
+
+    print '{0:>16s} {1:>16s} {2:>9s}'.format(
+        'DataFrame (ms)', 'ShotVotes (ms)', 'speed-up')
+    print '{0:16.3f} {1:16.3f} {2:8.1f}x'.format(
+        1000 * dataframe / samples, 1000 * counter / samples,
+        dataframe / counter)
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    shots = [int(n) for n in arguments['--shots'].split(',')]
+    votes = int(arguments['--votes'])
+    names = int(arguments['--names'])
+    others = [int(n) for n in arguments['--window'].split(',')]
+    samples = int(arguments['--samples'])
+    repeat = int(arguments['--repeat'])
+
+    if arguments['store']:
+        benchmark_store(shots, votes, names, repeat)
+
+    if arguments['window']:
+        benchmark_window(shots, others, names, repeat)
+
+    if arguments['consensus']:
+        benchmark_consensus(samples, votes, repeat)
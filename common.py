@@ -36,6 +36,18 @@ from sklearn.isotonic import IsotonicRegression
 from pandas import read_table
 
 import os.path
+import sys
+import json
+import sqlite3
+import threading
+from Queue import Queue
+from collections import deque, OrderedDict
+import cProfile
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from tortilla.utils import bunchify
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException
 
 import logging
 from logging import Formatter, NullHandler
@@ -62,18 +74,570 @@ def create_logger(robot, path=None, debug=False):
     return logger
 
 
+class Profiler(object):
+    """
+    >>> profiler = create_profiler(robot, path=pathToLogDir, enabled=True)
+    >>> profiler.phase('load')    # start timing 'load' phase
+    >>> profiler.phase('update')  # stop timing 'load', start timing 'update'
+    >>> profiler.summary()        # log timing of current cycle and reset
+    >>> for item in profiler.cycles(items, 'dequeue'):
+    ...     pass                      # one cycle per item
+
+    With `cprofile` (and `path`), cProfile stats of the latest cycle are
+    dumped into '{robot}.prof' in this directory as well (overwritten by
+    every cycle). cProfile only sees the thread that created the profiler:
+    work done in other threads (e.g. prefetching) is missing from these
+    stats, though its phases are still timed. With `interval`, cycles are merged until at
+    least `interval` seconds have passed since the previous summary.
+    Each thread times its own phases, and they all add up in the summary
+    of the current cycle.
+    """
+
+    def __init__(self, robot, logger, path=None, enabled=False,
+                 cprofile=False, interval=0):
+        super(Profiler, self).__init__()
+        self.robot = robot
+        self.logger = logger
+        self.path = path
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.interval = interval
+
+        self.cycle = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self._reset()
+
+    def _reset(self):
+
+        with self.lock:
+            self.seconds = OrderedDict()
+            self.calls = {}
+        self.local.current = None
+        self.start = time.time()
+
+        self.profile = None
+        if self.cprofile and self.path is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def phase(self, name):
+
+        if not self.enabled:
+            return
+
+        now = time.time()
+
+        current = getattr(self.local, 'current', None)
+        if current is not None:
+            phase, started = current
+            with self.lock:
+                self.seconds[phase] = (
+                    self.seconds.get(phase, 0.) + now - started)
+                self.calls[phase] = self.calls.get(phase, 0) + 1
+
+        self.local.current = None if name is None else (name, now)
+
+    def summary(self):
+
+        if not (self.enabled or self.cprofile):
+            return
+
+        self.cycle += 1
+
+        elapsed = time.time() - self.start
+        if elapsed < self.interval:
+            return
+
+        self.phase(None)
+
+        # only keep stats of the latest cycle (one file per robot)
+        if self.profile is not None:
+            self.profile.disable()
+            path = os.path.join(self.path, '{robot}.prof'.format(
+                robot=self.robot))
+            self.profile.dump_stats(path + '.tmp')
+            os.rename(path + '.tmp', path)
+
+        if self.enabled:
+            with self.lock:
+                phases = ' / '.join(
+                    '{phase} {seconds:.3f}s ({n:d}x)'.format(
+                        phase=phase, seconds=seconds, n=self.calls[phase])
+                    for phase, seconds in self.seconds.iteritems())
+            self.logger.info(
+                'profile - cycle {cycle:d} - {elapsed:.3f}s - {phases}'.format(
+                    cycle=self.cycle, elapsed=elapsed, phases=phases))
+
+        self._reset()
+
+    def cycles(self, items, phase):
+        """Iterate over items (one cycle per item), timing `phase` for each"""
+
+        items = iter(items)
+        while True:
+            self.phase(phase)
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            self.phase(None)
+            yield item
+            self.summary()
+
+
+def create_profiler(robot, path=None, enabled=False, cprofile=False,
+                    interval=0):
+    # rely on the logger set up by create_logger
+    logger = logging.getLogger(robot)
+    return Profiler(robot, logger, path=path, enabled=enabled,
+                    cprofile=cprofile, interval=interval)
+
+
+def _call(func, item):
+    try:
+        return item, True, func(item)
+    except Exception:
+        return item, False, sys.exc_info()
+
+
+def threaded_imap(func, items, workers=1, window=None, ordered=True):
+    """Apply `func` to every item using a pool of threads
+
+    >>> for item, result in threaded_imap(func, items, workers=4):
+    ...     pass
+
+    At most `window` items (defaults to twice the number of workers) are
+    in flight at any time. (item, result) pairs are yielded in input order
+    when `ordered` is True, and as soon as they are completed otherwise.
+    An exception raised by `func` for one item is raised again when that
+    item is reached, with its original traceback.
+
+    With one worker and an explicit `window`, `func` is applied by a
+    background thread, up to `window - 1` items ahead of the consumer.
+    """
+
+    # no need for a pool of threads
+    if workers < 1 or (workers == 1 and window is None):
+        for item in items:
+            yield item, func(item)
+        return
+
+    if window is None:
+        window = 2 * workers
+
+    pool = ThreadPool(workers)
+    completed = Queue()
+    pending = deque()
+    items = iter(items)
+
+    try:
+        while True:
+
+            # keep at most `window` items in flight
+            while len(pending) < window:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                pending.append(pool.apply_async(
+                    _call, (func, item),
+                    callback=None if ordered else completed.put))
+
+            if not pending:
+                break
+
+            if ordered:
+                item, success, result = pending.popleft().get()
+            else:
+                item, success, result = completed.get()
+                # in this mode, `pending` is only used to count items in flight
+                pending.pop()
+
+            if not success:
+                raise result[0], result[1], result[2]
+
+            yield item, result
+
+    finally:
+        pool.terminate()
+
+
+class RateLimiter(object):
+    """
+    >>> limiter = RateLimiter(rate=10)  # at most 10 calls per second
+    >>> limiter.wait()  # (thread-safe) blocks until next call is allowed
+    """
+
+    def __init__(self, rate=None):
+        super(RateLimiter, self).__init__()
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def wait(self):
+
+        # no limit
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + 1. / self.rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Metrics(object):
+    """Per-method Camomile API call metrics
+
+    >>> metrics = Metrics('robot_label_in')
+    >>> metrics.observe('getAnnotations', 0.2, error=False)
+    >>> metrics.transfer('getAnnotations', sent=0, received=1024)
+    >>> metrics.export('/path/to/robot_label_in.prom')
+    """
+
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1., 2.5, 5., 10., 30., 60.]
+
+    def __init__(self, robot):
+        super(Metrics, self).__init__()
+        self.robot = robot
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.errors = {}
+        self.seconds = {}
+        self.buckets = {}
+        self.sent = {}
+        self.received = {}
+
+    def observe(self, method, seconds, error=False):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.seconds[method] = self.seconds.get(method, 0.) + seconds
+            if error:
+                self.errors[method] = self.errors.get(method, 0) + 1
+            buckets = self.buckets.setdefault(method, [0] * len(self.BUCKETS))
+            for b, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    buckets[b] += 1
+
+    def transfer(self, method, sent=0, received=0):
+        with self.lock:
+            self.sent[method] = self.sent.get(method, 0) + sent
+            self.received[method] = self.received.get(method, 0) + received
+
+    def export(self, path):
+        """Save metrics in Prometheus text format"""
+
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append('# HELP {name} {help}'.format(name=name, help=help))
+            lines.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+            for method, value in sorted(values.iteritems()):
+                lines.append(
+                    '{name}{{robot="{robot}",method="{method}"}} {value}'
+                    .format(name=name, robot=self.robot, method=method,
+                            value=value))
+
+        with self.lock:
+
+            metric('camomile_calls_total', 'counter',
+                   'Number of Camomile API calls.', self.calls)
+            metric('camomile_errors_total', 'counter',
+                   'Number of failed Camomile API calls.', self.errors)
+            metric('camomile_sent_bytes_total', 'counter',
+                   'Bytes sent to Camomile API.', self.sent)
+            metric('camomile_received_bytes_total', 'counter',
+                   'Bytes received from Camomile API.', self.received)
+
+            name = 'camomile_call_duration_seconds'
+            lines.append('# HELP {name} Camomile API call latency.'.format(
+                name=name))
+            lines.append('# TYPE {name} histogram'.format(name=name))
+            for method in sorted(self.calls):
+                labels = 'robot="{robot}",method="{method}"'.format(
+                    robot=self.robot, method=method)
+                for bound, count in zip(self.BUCKETS, self.buckets[method]):
+                    lines.append(
+                        '{name}_bucket{{{labels},le="{le}"}} {n}'.format(
+                            name=name, labels=labels, le=bound, n=count))
+                lines.append('{name}_bucket{{{labels},le="+Inf"}} {n}'.format(
+                    name=name, labels=labels, n=self.calls[method]))
+                lines.append('{name}_sum{{{labels}}} {value}'.format(
+                    name=name, labels=labels, value=self.seconds[method]))
+                lines.append('{name}_count{{{labels}}} {n}'.format(
+                    name=name, labels=labels, n=self.calls[method]))
+
+        # write then rename so that collectors never read a partial file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, path)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTP adapter with a default timeout"""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(PooledHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = self.timeout
+        return super(PooledHTTPAdapter, self).send(request, **kwargs)
+
+
+class AnnotationMirror(object):
+    """
+    >>> mirror = AnnotationMirror(pathToSQLite)
+    >>> mirror.store(layer, medium, annotations)
+    >>> annotations = mirror.load(layer, medium, count=len(annotations))
+    >>> mirror.invalidate_annotations([annotationID])
+    """
+
+    def __init__(self, path):
+        super(AnnotationMirror, self).__init__()
+        self.path = path
+
+        # may be shared by getAnnotations_iter worker threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False)
+        # mirrors in previous formats are simply dropped
+        self.db.execute('DROP TABLE IF EXISTS annotations')
+        self.db.execute('DROP TABLE IF EXISTS mirror')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS media ('
+            'layer TEXT, medium TEXT, count INTEGER, synced REAL, '
+            'annotations TEXT, PRIMARY KEY (layer, medium))')
+        # annotation ID --> (layer, medium) it is mirrored with
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS ids ('
+            'annotation TEXT PRIMARY KEY, layer TEXT, medium TEXT)')
+        self.db.commit()
+
+    def load(self, layer, medium, count=None, max_age=None):
+        """Get mirrored annotations
+
+        Returns None when (layer, medium) has never been mirrored (or was
+        invalidated since), when its number of annotations differs from
+        `count` or when it was synced more than `max_age` seconds ago.
+        """
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT count, synced, annotations FROM media '
+                'WHERE layer = ? AND medium = ?', (layer, medium)).fetchone()
+
+        if row is None:
+            return None
+
+        n, synced, annotations = row
+
+        if count is not None and n != count:
+            return None
+
+        if max_age is not None and time.time() - synced > max_age:
+            return None
+
+        return bunchify(json.loads(annotations))
+
+    def store(self, layer, medium, annotations):
+        data = json.dumps(annotations)
+        with self.lock:
+            self._invalidate(layer, medium)
+            self.db.execute(
+                'INSERT INTO media '
+                '(layer, medium, count, synced, annotations) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (layer, medium, len(annotations), time.time(), data))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO ids (annotation, layer, medium) '
+                'VALUES (?, ?, ?)',
+                [(annotation['_id'], layer, medium)
+                 for annotation in annotations])
+            self.db.commit()
+
+    def _invalidate(self, layer, medium=None):
+        # (caller holds the lock and commits)
+        if medium is None:
+            self.db.execute('DELETE FROM media WHERE layer = ?', (layer, ))
+            self.db.execute('DELETE FROM ids WHERE layer = ?', (layer, ))
+        else:
+            self.db.execute(
+                'DELETE FROM media WHERE layer = ? AND medium = ?',
+                (layer, medium))
+            self.db.execute(
+                'DELETE FROM ids WHERE layer = ? AND medium = ?',
+                (layer, medium))
+
+    def invalidate(self, layer, medium=None):
+        with self.lock:
+            self._invalidate(layer, medium=medium)
+            self.db.commit()
+
+    def invalidate_annotations(self, annotations):
+        """Invalidate media containing any of these annotation IDs"""
+        with self.lock:
+            for annotation in annotations:
+                row = self.db.execute(
+                    'SELECT layer, medium FROM ids WHERE annotation = ?',
+                    (annotation, )).fetchone()
+                if row is not None:
+                    self._invalidate(*row)
+            self.db.commit()
+
+
+def deep_getsizeof(obj, seen=None):
+    """Approximate memory used by `obj` and everything it contains"""
+
+    if seen is None:
+        seen = set([])
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_getsizeof(key, seen) + deep_getsizeof(value, seen)
+
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += deep_getsizeof(item, seen)
+
+    return size
+
+
+class LRUCache(object):
+    """
+    >>> cache = LRUCache(load, max_items=100, max_mb=512)
+    >>> value = cache[key]  # calls load(key) unless already cached
+    >>> value = cache.peek(key)  # None unless already cached
+    >>> cache.resize(key)   # value of key has grown or shrunk
+
+    Least recently used keys are evicted as soon as there are more than
+    `max_items` of them or their values use more than `max_mb` megabytes.
+    The most recently used key is never evicted. Evicted keys are loaded
+    again the next time they are needed.
+    """
+
+    def __init__(self, load, max_items=None, max_mb=None):
+        super(LRUCache, self).__init__()
+        self.load = load
+        self.max_items = max_items
+        self.max_bytes = None if max_mb is None else max_mb * 1024 ** 2
+
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+        self.sizes = {}
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, key):
+
+        with self.lock:
+            if key in self.values:
+                # mark as most recently used
+                value = self.values.pop(key)
+                self.values[key] = value
+                return value
+
+        # load outside of the lock as it may take a while
+        value = self.load(key)
+
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = value
+            self.sizes[key] = self._sizeof(value)
+            self._evict()
+
+        return value
+
+    def peek(self, key):
+        """Cached value of `key` (None if not cached), not marked as used"""
+        with self.lock:
+            return self.values.get(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.sizes.clear()
+
+    def resize(self, key):
+        with self.lock:
+            if key in self.values:
+                self.sizes[key] = self._sizeof(self.values[key])
+                self._evict()
+
+    def _sizeof(self, value):
+        if self.max_bytes is None:
+            return 0
+        return deep_getsizeof(value)
+
+    def nbytes(self):
+        return sum(self.sizes.itervalues())
+
+    def _evict(self):
+
+        while len(self.values) > 1:
+
+            tooMany = (self.max_items is not None and
+                       len(self.values) > self.max_items)
+            tooLarge = (self.max_bytes is not None and
+                        self.nbytes() > self.max_bytes)
+            if not (tooMany or tooLarge):
+                break
+
+            key, _ = self.values.popitem(last=False)
+            del self.sizes[key]
+
+
 class RobotCamomile(Camomile):
 
     def __init__(self, url, login, password=None,
-                 dryrun=False, period=3600, logger=None):
+                 dryrun=False, period=3600, logger=None,
+                 cache_dir=None, cache_max_age=86400, names_ttl=3600,
+                 pool_size=10, timeout=None, metrics=None):
         super(RobotCamomile, self).__init__(url)
+
+        # configure the HTTP session shared by all requests before the
+        # first one (login) is sent. requests already keeps connections
+        # alive and asks for gzip/deflate compressed responses.
+        self.session = self._api._parent.session
+        adapter = PooledHTTPAdapter(timeout=timeout,
+                                    pool_connections=pool_size,
+                                    pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # (opt-in) per-method call metrics, exported to `metrics` file
+        self.metrics = None
+        self.metrics_path = metrics
+        if metrics is not None:
+            robot, _ = os.path.splitext(os.path.basename(metrics))
+            self.metrics = Metrics(robot)
+            self._instrument()
+
         self.dryrun = dryrun
         self.period = period
         if password is None:
             password = getpass('Password for %s: ' % login)
         self.login(login, password)
         if logger is None:
-            logger = NullHandler()
+            logger = logging.getLogger('RobotCamomile')
+            logger.addHandler(NullHandler())
         self.logger = logger
 
         # (not-so) smart queue length monitoring
@@ -82,10 +646,127 @@ class RobotCamomile(Camomile):
         # n --> esimated pickLength()
         self.cache = {}
 
+        # (opt-in) on-disk mirror of annotations
+        # refreshed when the number of annotations of a medium changes,
+        # when this client changes its annotations or when it is older
+        # than cache_max_age seconds
+        self.mirror = None
+        if cache_dir is not None:
+            self.mirror = AnnotationMirror(
+                os.path.join(cache_dir, 'annotations.sqlite'))
+        self.cache_max_age = cache_max_age
+
+        # name --> id indices used by get*ByName
+        # dict (kind, corpus):
+        # @ --> date of last bulk fetch
+        # index --> {name: [ids]}
+        self.names = {}
+        self.names_ttl = names_ttl
+
+    def _instrument(self):
+
+        # keep track of the API method being called (by each thread)
+        # so that the response hook knows who to account bytes to
+        current = threading.local()
+
+        def hook(response, *args, **kwargs):
+            method = getattr(current, 'method', None)
+            if method is None:
+                return
+            sent = len(response.request.body or '')
+            # number of bytes actually read from the wire (compressed)
+            _ = response.content
+            self.metrics.transfer(
+                method, sent=sent, received=response.raw.tell())
+
+        self.session.hooks['response'].append(hook)
+
+        def instrument(name, func):
+            def instrumented(*args, **kwargs):
+                current.method = name
+                start = time.time()
+                error = False
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    # popping an empty queue is not a failure
+                    error = not self._isEmptyQueueError(e)
+                    raise
+                finally:
+                    current.method = None
+                    self.metrics.observe(
+                        name, time.time() - start, error=error)
+            instrumented.__name__ = func.__name__
+            instrumented.__doc__ = func.__doc__
+            return instrumented
+
+        # wrap every public method of the Camomile API
+        for name, func in Camomile.__dict__.iteritems():
+            if name.startswith('_') or not callable(func):
+                continue
+            setattr(self, name, instrument(name, getattr(self, name)))
+
+    def exportMetrics(self):
+        if self.metrics is not None:
+            self.metrics.export(self.metrics_path)
+
+    def _fetchNames(self, kind, corpus=None):
+
+        if kind == 'user':
+            return [(user.username, user._id) for user in self.getUsers()]
+
+        if kind == 'group':
+            return [(group.name, group._id) for group in self.getGroups()]
+
+        if kind == 'queue':
+            return [(queue.name, queue._id) for queue in self.getQueues()]
+
+        if kind == 'corpus':
+            return [(corpus.name, corpus._id) for corpus in self.getCorpora()]
+
+        if kind == 'layer':
+            return [(layer.name, layer._id)
+                    for layer in self.getLayers(corpus)]
+
+    def _getNameIndex(self, kind, corpus=None):
+
+        key = (kind, corpus)
+
+        # (re-)build name --> [ids] index from one bulk fetch
+        # when it is missing or older than names_ttl seconds
+        if ((key not in self.names) or
+                (datetime.now() - self.names[key]['@'])
+                .total_seconds() > self.names_ttl):
+            index = {}
+            for name, _id in self._fetchNames(kind, corpus=corpus):
+                index.setdefault(name, []).append(_id)
+            self.names[key] = {}
+            self.names[key]['index'] = index
+            self.names[key]['@'] = datetime.now()
+
+        return self.names[key]['index']
+
+    def _addName(self, kind, name, _id, corpus=None):
+        # update index in place (only if it is already loaded)
+        key = (kind, corpus)
+        if key in self.names:
+            self.names[key]['index'].setdefault(name, []).append(_id)
+
+    def invalidateNames(self, kind=None):
+        """Force next get*ByName call to reload name index
+
+        Parameters
+        ----------
+        kind : {'user', 'group', 'queue', 'corpus', 'layer'}, optional
+            Defaults to invalidating all indices.
+        """
+        for key in list(self.names):
+            if kind is None or key[0] == kind:
+                del self.names[key]
+
     def getUserByName(self, name):
 
-        matchingUsers = [user._id for user in self.getUsers()
-                         if user.username == name]
+        matchingUsers = self._getNameIndex('user').get(name, [])
 
         if len(matchingUsers) == 1:
             return matchingUsers[0]
@@ -96,8 +777,7 @@ class RobotCamomile(Camomile):
 
     def getGroupByName(self, name):
 
-        matchingGroups = [group._id for group in self.getGroups()
-                          if group.name == name]
+        matchingGroups = self._getNameIndex('group').get(name, [])
 
         if len(matchingGroups) == 1:
             return matchingGroups[0]
@@ -108,8 +788,7 @@ class RobotCamomile(Camomile):
 
     def getQueueByName(self, name):
 
-        matchingQueues = [queue._id for queue in self.getQueues()
-                          if queue.name == name]
+        matchingQueues = self._getNameIndex('queue').get(name, [])
 
         if len(matchingQueues) == 1:
             return matchingQueues[0]
@@ -123,8 +802,7 @@ class RobotCamomile(Camomile):
 
     def getCorpusByName(self, name):
 
-        matchingCorpora = [corpus._id for corpus in self.getCorpora()
-                           if corpus.name == name]
+        matchingCorpora = self._getNameIndex('corpus').get(name, [])
 
         if len(matchingCorpora) == 1:
             return matchingCorpora[0]
@@ -138,8 +816,8 @@ class RobotCamomile(Camomile):
 
     def getLayerByName(self, corpus, name):
 
-        matchingLayers = [layer._id for layer in self.getLayers(corpus)
-                          if layer.name == name]
+        matchingLayers = self._getNameIndex(
+            'layer', corpus=corpus).get(name, [])
 
         if len(matchingLayers) == 1:
             return matchingLayers[0]
@@ -151,22 +829,176 @@ class RobotCamomile(Camomile):
         msg = 'Found too many (%d) layers with name "%s".'
         raise ValueError(msg % (len(matchingLayers), name))
 
-    def dequeue_loop(self, queue):
+    # keep name indices up to date when creating or deleting resources
+
+    def createUser(self, username, password,
+                   description=None, role='user', returns_id=False):
+        result = super(RobotCamomile, self).createUser(
+            username, password, description=description, role=role,
+            returns_id=returns_id)
+        self._addName('user', username,
+                      result if returns_id else result._id)
+        return result
+
+    def createGroup(self, name, description=None, returns_id=False):
+        result = super(RobotCamomile, self).createGroup(
+            name, description=description, returns_id=returns_id)
+        self._addName('group', name,
+                      result if returns_id else result._id)
+        return result
+
+    def createQueue(self, name, description=None, returns_id=False):
+        result = super(RobotCamomile, self).createQueue(
+            name, description=description, returns_id=returns_id)
+        self._addName('queue', name,
+                      result if returns_id else result._id)
+        return result
+
+    def createCorpus(self, name, description=None, returns_id=False):
+        result = super(RobotCamomile, self).createCorpus(
+            name, description=description, returns_id=returns_id)
+        self._addName('corpus', name,
+                      result if returns_id else result._id)
+        return result
+
+    def createLayer(self, corpus, name, description=None,
+                    fragment_type=None, data_type=None,
+                    annotations=None, returns_id=False):
+        result = super(RobotCamomile, self).createLayer(
+            corpus, name, description=description,
+            fragment_type=fragment_type, data_type=data_type,
+            annotations=annotations, returns_id=returns_id)
+        self._addName('layer', name,
+                      result if returns_id else result._id,
+                      corpus=corpus)
+        return result
+
+    def deleteUser(self, user):
+        self.invalidateNames(kind='user')
+        return super(RobotCamomile, self).deleteUser(user)
+
+    def deleteGroup(self, group):
+        self.invalidateNames(kind='group')
+        return super(RobotCamomile, self).deleteGroup(group)
+
+    def deleteQueue(self, queue):
+        self.invalidateNames(kind='queue')
+        return super(RobotCamomile, self).deleteQueue(queue)
+
+    def deleteCorpus(self, corpus):
+        self.invalidateNames(kind='corpus')
+        return super(RobotCamomile, self).deleteCorpus(corpus)
+
+    def deleteLayer(self, layer):
+        self.invalidateNames(kind='layer')
+        return super(RobotCamomile, self).deleteLayer(layer)
+
+    def _isEmptyQueueError(self, error):
+        # Camomile answers "Empty queue." client error when popping
+        # an empty queue
+        response = getattr(error, 'response', None)
+        return (isinstance(error, HTTPError) and
+                response is not None and response.status_code < 500 and
+                'empty' in str(error).lower())
+
+    def dequeue_batch(self, queue, size=1):
+        """Pop up to `size` items (less if queue gets empty)
+
+        Errors other than the queue being empty are raised, unless some
+        items have already been popped: those are returned first (and the
+        error is likely to be raised again by the next call).
+        """
+
+        items = []
+        while len(items) < size:
+            try:
+                items.append(self.dequeue(queue))
+            except Exception as e:
+                if self._isEmptyQueueError(e):
+                    break
+                if not items:
+                    raise
+                self.logger.error(
+                    'could not pop more items ({error})'.format(error=e))
+                break
+        return items
+
+    def dequeue_batches(self, queue, size=1, min_wait=None):
+        """Endlessly pop batches of up to `size` items
+
+        When the queue is empty, wait `min_wait` seconds then twice as long
+        each time it is still empty, up to `period` seconds. Waiting time is
+        reset as soon as items show up. Defaults to always waiting `period`
+        seconds. Server and network errors are retried the same way.
+
+        Note that a whole batch is popped before it is processed: items
+        of a batch whose processing fails are lost (up to `size` items).
+        """
 
         # do not 'pop' nor 'loop' in dry-run mode
         if self.dryrun:
-            for item in self.getQueue(queue).list:
-                yield item
+            items = self.getQueue(queue).list
+            for i in range(0, len(items), size):
+                yield items[i:i + size]
             return
 
+        initial = self.period if min_wait is None else min_wait
+        wait = initial
+
         while True:
+
             try:
-                item = self.dequeue(queue)
+                items = self.dequeue_batch(queue, size=size)
+
+            # server or network failure: wait (with the same backoff as
+            # for an empty queue) and try again. client errors (e.g.
+            # unknown queue or missing permission) will not go away.
+            except RequestException as e:
+                response = getattr(e, 'response', None)
+                if response is not None and response.status_code < 500:
+                    raise
+                self.logger.error(
+                    'could not pop items ({error}), '
+                    'waiting for {wait:g}s'.format(error=e, wait=wait))
+                time.sleep(wait)
+                wait = min(2 * wait, self.period)
+                continue
+
+            if items:
+                wait = initial
+                yield items
+                self.exportMetrics()
+                continue
+
+            self.logger.debug('empty queue (waiting for %gs)' % wait)
+            time.sleep(wait)
+            wait = min(2 * wait, self.period)
+
+    def dequeue_loop(self, queue, batch=1, min_wait=None):
+
+        for items in self.dequeue_batches(
+                queue, size=batch, min_wait=min_wait):
+            for item in items:
                 yield item
-            except Exception:
-                self.logger.debug(
-                    'empty queue (waiting for %ds)' % self.period)
-                time.sleep(self.period)
+
+    def _pickLength(self, queue):
+
+        now = datetime.now()
+        n = self.pickLength(queue)
+
+        # update consumption rate (items per second) with what has been
+        # popped since the previous sample (smoothed by moving average)
+        if queue in self.cache:
+            elapsed = (now - self.cache[queue]['@']).total_seconds()
+            if elapsed > 0:
+                rate = max(0, self.cache[queue]['n'] - n) / elapsed
+                previous = self.cache[queue].get('rate', rate)
+                self.cache[queue]['rate'] = 0.5 * rate + 0.5 * previous
+        else:
+            self.cache[queue] = {}
+
+        self.cache[queue]['n'] = n
+        self.cache[queue]['@'] = now
 
     def enqueue_fair(self, queue, item, limit=np.inf):
 
@@ -175,22 +1007,76 @@ class RobotCamomile(Camomile):
         if ((queue not in self.cache) or
                 (datetime.now() - self.cache[queue]['@'])
                 .total_seconds() > timeout):
-            self.cache[queue] = {}
-            self.cache[queue]['n'] = self.pickLength(queue)
-            self.cache[queue]['@'] = datetime.now()
+            self._pickLength(queue)
 
         # wait until the queue has been popped
         while self.cache[queue]['n'] > limit:
             self.logger.debug(
                 'full queue (waiting for %ds)' % self.period)
             time.sleep(timeout)
-            self.cache[queue]['n'] = self.pickLength(queue)
-            self.cache[queue]['@'] = datetime.now()
+            self._pickLength(queue)
 
         self.enqueue(queue, item)
         self.cache[queue]['n'] += 1
 
-    def duplicate_layer(self, layer, returns_id=False):
+    def enqueue_fair_batch(self, queue, items, limit=np.inf, size=20):
+        """Push items by chunks of at most `size`, keeping ~`limit` in queue
+
+        How many items are pushed is always decided from an actual
+        pickLength() sample (plus the items pushed since then), taken again
+        whenever it leaves no room for the next chunk, and at least every
+        `period` seconds. The consumption rate observed between successive
+        samples only decides how long to wait for annotators to make room.
+        """
+
+        items = iter(items)
+        chunk = list(islice(items, size))
+
+        while chunk:
+
+            if ((queue not in self.cache) or
+                    (datetime.now() - self.cache[queue]['@'])
+                    .total_seconds() > self.period):
+                self._pickLength(queue)
+
+            # last sampled length, plus items pushed since then
+            room = limit - self.cache[queue]['n']
+
+            # annotators may have made room since last sample
+            if room < len(chunk):
+                self._pickLength(queue)
+                room = limit - self.cache[queue]['n']
+
+            # wait until annotators are expected to have made room
+            if room < 1:
+                rate = self.cache[queue].get('rate', 0.)
+                wait = ((len(chunk) - room) / rate if rate > 0
+                        else self.period)
+                wait = min(max(1., wait), self.period)
+                self.logger.debug(
+                    'full queue (waiting for %ds)' % wait)
+                time.sleep(wait)
+                continue
+
+            # push as many items as there is room for, in one request
+            n = int(min(room, len(chunk)))
+            pushed, chunk = chunk[:n], chunk[n:]
+            self.enqueue(queue, pushed)
+            self.cache[queue]['n'] += len(pushed)
+
+            chunk.extend(islice(items, size - len(chunk)))
+
+    def duplicate_layer(self, layer, returns_id=False, workers=1,
+                        chunk=1000):
+        """Copy layer and its annotations
+
+        Media are read by `workers` threads in parallel while annotations
+        are written by chunks of at most `chunk` annotations. Copied media
+        are checkpointed in the 'copying' field of the copy description
+        (removed once the copy is complete) so that an interrupted copy
+        of the same layer is resumed rather than restarted. Layers whose
+        description still has a 'copying' field should not be used.
+        """
 
         # get original layer and its fields
         original = self.getLayer(layer)
@@ -198,47 +1084,287 @@ class RobotCamomile(Camomile):
         name = original.name + ' [copy]'
         fragment_type = original.fragment_type
         data_type = original.data_type
-        description = original.description
 
-        # keep track of original layer
-        description.copy = layer
+        # look for an interrupted copy of this layer
+        copy = None
+        for candidate in self.getLayers(corpus, data_type=data_type):
+            description = candidate.description
+            # HACK - description might be u''
+            if not description:
+                continue
+            if description.get('copy', None) != layer:
+                continue
+            if 'copying' not in description:
+                continue
+            copy = candidate._id
+            self.logger.info(
+                'resuming copy {copy} of {layer}'.format(
+                    copy=copy, layer=layer))
+            break
+
+        if copy is None:
+
+            description = original.description
+
+            # keep track of original layer (and of copy progress)
+            description.copy = layer
+            description.copying = []
+
+            # create empty copy
+            copy = self.createLayer(
+                corpus, name, description=description,
+                fragment_type=fragment_type, data_type=data_type,
+                returns_id=True)
+
+            media = self.getMedia(corpus, returns_id=True)
 
-        # create empty copy
-        copy = self.createLayer(
-            corpus, name, description=description,
-            fragment_type=fragment_type, data_type=data_type,
-            returns_id=True)
+        else:
+
+            copied = set(description.copying)
+            media = [medium
+                     for medium in self.getMedia(corpus, returns_id=True)
+                     if medium not in copied]
 
-        # copy annotations medium by medium
-        media = self.getMedia(corpus, returns_id=True)
-        for medium in media:
-            annotations = self.getAnnotations(
-                layer=layer, medium=medium)
-            self.createAnnotations(copy, annotations, returns_id=True)
+            # remove annotations of media that were only partially copied
+            for medium in media:
+                for annotation in self.getAnnotations(
+                        layer=copy, medium=medium, returns_id=True):
+                    self.deleteAnnotation(annotation)
+
+        # copy annotations medium by medium, chunk by chunk
+        for medium, annotations in self.getAnnotations_iter(
+                layer, media=media, workers=workers, ordered=False):
+
+            annotations = [{'id_medium': annotation.id_medium,
+                            'fragment': annotation.fragment,
+                            'data': annotation.data}
+                           for annotation in annotations]
+
+            for i in range(0, len(annotations), chunk):
+                self.createAnnotations(
+                    copy, annotations[i:i + chunk], returns_id=True)
+
+            # checkpoint
+            description.copying.append(medium)
+            self.updateLayer(copy, description=description)
+
+        # mark copy as complete
+        del description['copying']
+        self.updateLayer(copy, description=description)
 
         if returns_id:
             return copy
 
         return self.getLayer(copy)
 
-    def getAnnotations_iter(self, layer, returns_id=False):
-        corpus = self.getLayer(layer).id_corpus
-        media = self.getMedia(corpus, returns_id=True)
-        for medium in media:
-            annotations = self.getAnnotations(
+    def getMediumAnnotations(self, layer, medium, returns_id=False):
+
+        if self.mirror is None:
+            return self.getAnnotations(
                 layer=layer, medium=medium, returns_id=returns_id)
-            yield medium, annotations
 
-    def emptyLayerByName(self, corpus, name):
+        # cheap check: compare number of annotations with the mirror
+        # (annotations replaced by this client invalidate the mirror,
+        # those replaced by other clients wait for cache_max_age)
+        count = self.getAnnotations(
+            layer=layer, medium=medium, returns_count=True)
+        annotations = self.mirror.load(
+            layer, medium, count=count, max_age=self.cache_max_age)
 
-        layer = self.getLayerByName(corpus, name)
-        for _, annotations in self.getAnnotations_iter(layer, returns_id=True):
-            for annotation in annotations:
-                self.deleteAnnotation(annotation)
+        # (re-)download annotations when the mirror is out of date
+        if annotations is None:
+            self.logger.debug(
+                'mirror - syncing layer {layer} / medium {medium}'.format(
+                    layer=layer, medium=medium))
+            annotations = self.getAnnotations(layer=layer, medium=medium)
+            self.mirror.store(layer, medium, annotations)
 
-    def emptyQueueByName(self, name):
+        if returns_id:
+            return [annotation._id for annotation in annotations]
+
+        return annotations
+
+    # keep annotation mirror up to date with changes made by this client
+    # (invalidated once changes are done, so that they are not missed by
+    # a concurrent sync)
+
+    def createAnnotation(self, layer, medium=None, fragment=None, data=None,
+                         returns_id=False):
+        result = super(RobotCamomile, self).createAnnotation(
+            layer, medium=medium, fragment=fragment, data=data,
+            returns_id=returns_id)
+        if self.mirror is not None:
+            self.mirror.invalidate(layer, medium=medium)
+        return result
+
+    def createAnnotations(self, layer, annotations, returns_id=False):
+        result = super(RobotCamomile, self).createAnnotations(
+            layer, annotations, returns_id=returns_id)
+        if self.mirror is not None:
+            for medium in set(annotation['id_medium']
+                              for annotation in annotations):
+                self.mirror.invalidate(layer, medium=medium)
+        return result
+
+    def updateAnnotation(self, annotation, fragment=None, data=None):
+        result = super(RobotCamomile, self).updateAnnotation(
+            annotation, fragment=fragment, data=data)
+        if self.mirror is not None:
+            self.mirror.invalidate_annotations([annotation])
+        return result
+
+    def deleteAnnotation(self, annotation):
+        result = super(RobotCamomile, self).deleteAnnotation(annotation)
+        if self.mirror is not None:
+            self.mirror.invalidate_annotations([annotation])
+        return result
+
+    def getAnnotations_iter(self, layer, returns_id=False, media=None,
+                            workers=1, window=None, ordered=True):
+        """Iterate over (medium, annotations) pairs
+
+        With workers > 1, media are fetched concurrently by a pool of
+        threads (see `threaded_imap` for `window` and `ordered`).
+        """
+
+        # default to all media of the layer corpus
+        if media is None:
+            corpus = self.getLayer(layer).id_corpus
+            media = self.getMedia(corpus, returns_id=True)
+
+        def fetch(medium):
+            try:
+                return self.getMediumAnnotations(
+                    layer, medium, returns_id=returns_id)
+            except Exception:
+                self.logger.error(
+                    'could not get annotations of layer {layer} / '
+                    'medium {medium}'.format(layer=layer, medium=medium))
+                raise
+
+        for medium, annotations in threaded_imap(
+                fetch, media, workers=workers, window=window,
+                ordered=ordered):
+            yield medium, annotations
+
+    def deleteAnnotations(self, annotations, workers=1, rate=None,
+                          progress=1000, ignore_missing=False):
+        """Delete annotations from a pool of threads
+
+        Parameters
+        ----------
+        annotations : iterable
+            Annotation IDs.
+        workers : int, optional
+            Number of deletions running in parallel. Defaults to 1.
+        rate : float, optional
+            Maximum number of deletions per second. Defaults to no limit.
+        progress : int, optional
+            Log progress every `progress` deletions.
+        ignore_missing : boolean, optional
+            Do not fail on annotations that no longer exist.
+
+        Returns
+        -------
+        deleted : int
+            Number of deleted annotations.
+        """
+
+        limiter = RateLimiter(rate=rate)
+
+        def delete(annotation):
+            limiter.wait()
+            try:
+                self.deleteAnnotation(annotation)
+            except HTTPError as e:
+                response = getattr(e, 'response', None)
+                if not (ignore_missing and response is not None and
+                        response.status_code == 404):
+                    raise
+                self.logger.debug(
+                    'annotation {annotation} was already deleted'.format(
+                        annotation=annotation))
+
+        start = time.time()
+        deleted = 0
+        for _ in threaded_imap(delete, annotations,
+                               workers=workers, ordered=False):
+            deleted += 1
+            if deleted % progress == 0:
+                self.logger.info(
+                    'deleted {n:d} annotations '
+                    '({r:.1f} per second)'.format(
+                        n=deleted, r=deleted / (time.time() - start)))
+
+        return deleted
+
+    def emptyLayersByName(self, corpus, names, workers=1, rate=None,
+                          dryrun=False):
+        """Delete all annotations of layers
+
+        Parameters
+        ----------
+        corpus : str
+            Corpus ID.
+        names : list
+            Layer names.
+        workers, rate :
+            See `deleteAnnotations`.
+        dryrun : boolean, optional
+            Only count annotations that would be deleted.
+
+        Returns
+        -------
+        counts : dict
+            Number of (deleted or to be deleted) annotations per layer name.
+        """
+
+        counts = {}
+
+        for name in names:
+
+            layer = self.getLayerByName(corpus, name)
+
+            if dryrun:
+                counts[name] = sum(
+                    len(annotations) for _, annotations
+                    in self.getAnnotations_iter(
+                        layer, returns_id=True, workers=workers))
+                self.logger.info(
+                    '{name} - {n:d} annotations to delete'.format(
+                        name=name, n=counts[name]))
+                continue
+
+            # stream annotation IDs medium by medium
+            annotations = (annotation for _, annotations
+                           in self.getAnnotations_iter(
+                               layer, returns_id=True, workers=workers)
+                           for annotation in annotations)
+
+            counts[name] = self.deleteAnnotations(
+                annotations, workers=workers, rate=rate)
+
+            self.logger.info(
+                '{name} - {n:d} annotations deleted'.format(
+                    name=name, n=counts[name]))
+
+            if self.mirror is not None:
+                self.mirror.invalidate(layer)
+
+        return counts
+
+    def emptyLayerByName(self, corpus, name, workers=1, rate=None,
+                         dryrun=False):
+        counts = self.emptyLayersByName(
+            corpus, [name], workers=workers, rate=rate, dryrun=dryrun)
+        return counts[name]
+
+    def emptyQueueByName(self, name, dryrun=False):
         queue = self.getQueueByName(name)
-        self.updateQueue(queue, elements=[])
+        n = self.pickLength(queue)
+        if not dryrun:
+            self.updateQueue(queue, elements=[])
+        return n
 
 
 class HTMLTime(object):
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 CNRS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""Label consensus rules used by robot_label_out (and robot_label_in)"""
+
+from collections import Counter, OrderedDict
+
+UNKNOWN = '?unknown?'
+DONT_KNOW = 'dontKnow'
+
+
+class ShotVotes(object):
+    """Label annotations of one shot, and whether they reach a consensus
+
+    >>> votes = ShotVotes(annotations)  # annotation data of this shot
+    >>> votes.add({'annotator': 'john', 'unknown': False,
+    ...            'known': {'jane_doe': 'speakingFace'}})
+    >>> votes.has_unknown()        # someone annotated an unknown face
+    >>> votes.disagreements()      # number of person names they disagree on
+    >>> consensus, reason = votes.consensus()
+
+    Only the last annotation of each annotator is taken into account.
+    A person name that one annotator did not annotate counts as
+    'dontKnow' for this annotator if s/he annotated an unknown face,
+    and as 'noFace' otherwise.
+    """
+
+    def __init__(self, annotations=()):
+        super(ShotVotes, self).__init__()
+
+        # annotator --> (known, unknown)
+        self._votes = OrderedDict()
+
+        # every person name annotated so far
+        self._personNames = OrderedDict()
+
+        for data in annotations:
+            self.add(data)
+
+    def __len__(self):
+        return len(self._votes)
+
+    def add(self, data):
+        known = data.get('known', {})
+        unknown = data['unknown']
+        self._votes[data['annotator']] = (known, unknown)
+        for personName in known:
+            self._personNames[personName] = True
+
+    def annotators(self):
+        return list(self._votes)
+
+    def has_unknown(self):
+        return any(unknown for _, unknown in self._votes.itervalues())
+
+    def disagreements(self):
+        """Number of person names (and UNKNOWN) annotators disagree on"""
+        return sum(1 for personName in self._personNames.keys() + [UNKNOWN]
+                   if len(set(self.statuses(personName))) > 1)
+
+    def statuses(self, personName):
+        """Status of `personName` for each annotator"""
+
+        if personName == UNKNOWN:
+            return ['speakingFace' if unknown else 'noFace'
+                    for _, unknown in self._votes.itervalues()]
+
+        return [known.get(personName, DONT_KNOW if unknown else 'noFace')
+                for known, unknown in self._votes.itervalues()]
+
+    def consensus(self):
+        """Returns (consensus, None) or (None, reason for no consensus)
+
+        `consensus` is a {personName: status} dictionary, including the
+        status of UNKNOWN.
+        """
+
+        # no consensus until we have at least 2 annotators
+        nAnnotators = len(self._votes)
+        if nAnnotators < 2:
+            return None, 'only {n} annotators'.format(n=nAnnotators)
+
+        consensus = {}
+        for personName in self._personNames.keys() + [UNKNOWN]:
+
+            counts = Counter(self.statuses(personName))
+
+            # no consensus if the count of expressed status
+            # (ie not 'dontKnow') is smaller than 2
+            expressedCounts = nAnnotators - counts[DONT_KNOW]
+            if expressedCounts < 2:
+                return None, (
+                    'only {n} expressed annotation(s) for {p} '.format(
+                        n=expressedCounts, p=personName))
+
+            # no consensus if the most frequent is 'dontKnow'
+            # (including when it is tied with another status)
+            count = max(counts.itervalues())
+            if counts[DONT_KNOW] == count:
+                return None, (
+                    "most frequent state for {p} is 'dontKnow'".format(
+                        p=personName))
+            status = max(counts, key=counts.get)
+
+            # no consensus if the highest frequency is < 2
+            if count < 2:
+                return None, (
+                    'most frequent state for {p} only has {n} vote(s)'.format(
+                        p=personName, n=count))
+
+            # consensus if the most frequent is
+            # strictly more frequent than 50%
+            ratio = count / float(expressedCounts)
+            if ratio <= 0.5:
+                return None, (
+                    'most frequent state for {p} does not '
+                    'have majority ({r:d}%)'.format(
+                        p=personName, r=int(100 * ratio)))
+
+            consensus[personName] = status
+
+        return consensus, None
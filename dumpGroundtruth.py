@@ -40,6 +40,7 @@ Options:
                         [default: http://api.mediaeval.niderb.fr]
   --login=login         login [default: robot_leaderboard]
   --password=P45sw0Rd   Password
+  --cache-dir=DIR       Path to local annotation mirror.
 """
 
 from common import RobotCamomile
@@ -53,6 +54,7 @@ url = arguments['--url']
 outputDir = arguments['<output_dir>']
 login = arguments['--login']
 password = arguments['--password']
+cacheDir = arguments['--cache-dir']
 
 if login is None:
     login = raw_input('Login: ')
@@ -62,7 +64,7 @@ if password is None:
 now = datetime.strftime(datetime.today(), '%Y%m%d-%H%M')
 
 client = RobotCamomile(
-    url, 'robot_leaderboard', password=password)
+    url, 'robot_leaderboard', password=password, cache_dir=cacheDir)
 
 # test corpus
 test = client.getCorpusByName('mediaeval.test')
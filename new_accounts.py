@@ -78,7 +78,7 @@ with open(accounts_csv, 'r') as f:
             team = client.getGroupByName(teamName)
         except:
             print 'Creating {team}'.format(team=teamName)
-            team = client.createGroup(team, returns_id=True)
+            team = client.createGroup(teamName, returns_id=True)
 
         # create user
         try:
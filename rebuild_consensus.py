@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 CNRS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Rebuild MediaEval label consensus from all label annotations
+
+robot_label_out must be stopped during the rebuild (and restarted after):
+it keeps track of consensus and unknown annotations in memory, and would
+not know about the ones replaced by this script.
+
+Usage:
+  rebuild_consensus [options]
+
+Options:
+  -h --help                Show this screen.
+  --url=URL                Submission server URL
+                           [default: http://api.mediaeval.niderb.fr]
+  --login=login            login [default: robot_label]
+  --password=P45sw0Rd      Password
+  --no-unknown-consensus   Stop looking for consensus when unknown
+                           (and rebuild unknown layer as well).
+  --processes=N            Evaluate consensus with N processes [default: 1].
+  --workers=N              Load media and delete annotations with N threads
+                           [default: 4].
+  --chunk=N                Create at most N annotations per request
+                           [default: 1000].
+  --dry-run                Only print how many annotations would be
+                           created and deleted.
+"""
+
+from common import RobotCamomile
+from consensus import ShotVotes
+from docopt import docopt
+from getpass import getpass
+from multiprocessing import Pool
+
+arguments = docopt(__doc__, version='0.1')
+
+url = arguments['--url']
+login = arguments['--login']
+password = arguments['--password']
+noUnknownConsensus = arguments['--no-unknown-consensus']
+processes = int(arguments['--processes'])
+workers = int(arguments['--workers'])
+chunk = int(arguments['--chunk'])
+dryRun = arguments['--dry-run']
+
+if password is None:
+    password = getpass('{login} password: '.format(login=login))
+
+robot = RobotCamomile(url, login, password=password,
+                      pool_size=max(10, workers))
+
+if not dryRun:
+    print ('make sure robot_label_out is stopped '
+           '(and restart it once done)')
+
+# corpus id
+test = robot.getCorpusByName('mediaeval.test')
+
+# layer containing consensus annotations
+consensusLayer = robot.getLayerByName(
+    test, 'mediaeval.groundtruth.label.consensus')
+
+# layer containing shots with at least one annotated unknown
+unknownLayer = robot.getLayerByName(
+    test, 'mediaeval.groundtruth.label.unknown')
+
+# layer containing complete annotations for label grondtruth
+allLayer = robot.getLayerByName(
+    test, 'mediaeval.groundtruth.label.all')
+
+
+def evaluate(args):
+    """Returns (shot, 'unknown' | consensus | None)"""
+
+    shot, annotations = args
+    votes = ShotVotes(annotations)
+
+    if noUnknownConsensus and votes.has_unknown():
+        return shot, 'unknown'
+
+    consensus, _ = votes.consensus()
+    return shot, consensus
+
+
+def loadStored(layer):
+
+    # shot --> [(annotation ID, data)]
+    stored = {}
+    for _, annotations in robot.getAnnotations_iter(layer, workers=workers):
+        for annotation in annotations:
+            # HACK - data might be u'' (and is None for unknown layer)
+            data = annotation.get('data', None) or None
+            stored.setdefault(annotation.fragment, []).append(
+                (annotation._id, data))
+    return stored
+
+
+def diff(stored, target):
+    """Minimal changes turning `stored` into `target` annotations
+
+    `stored` maps shots to [(annotation ID, data)] and `target` maps shots
+    to the data of their only expected annotation. Returns shots needing a
+    new annotation, IDs of annotations to delete, and number of shots left
+    untouched.
+    """
+
+    create = []
+    delete = []
+    unchanged = 0
+
+    for shot in set(stored) | set(target):
+
+        annotations = stored.get(shot, [])
+
+        # shot should not be annotated at all
+        if shot not in target:
+            delete.extend(annotation for annotation, _ in annotations)
+            continue
+
+        # keep one annotation with the expected data, if any
+        matching = [annotation for annotation, data in annotations
+                    if data == target[shot]]
+        if matching:
+            keep = matching[0]
+            if len(annotations) == 1:
+                unchanged += 1
+        else:
+            keep = None
+            create.append(shot)
+
+        delete.extend(annotation for annotation, _ in annotations
+                      if annotation != keep)
+
+    return create, delete, unchanged
+
+
+def applyDiff(layer, name, stored, target):
+
+    create, delete, unchanged = diff(stored, target)
+
+    print ('{name}: {c:d} to create / {d:d} to delete / '
+           '{u:d} unchanged'.format(name=name, c=len(create),
+                                    d=len(delete), u=unchanged))
+
+    if dryRun:
+        return
+
+    annotations = [{'id_medium': MEDIUM[shot],
+                    'fragment': shot,
+                    'data': target[shot]} for shot in create]
+    for i in range(0, len(annotations), chunk):
+        robot.createAnnotations(
+            layer, annotations[i:i + chunk], returns_id=True)
+
+    robot.deleteAnnotations(delete, workers=workers)
+
+
+# load every vote once
+print 'loading votes'
+VOTES = {}
+MEDIUM = {}
+for medium, annotations in robot.getAnnotations_iter(
+        allLayer, workers=workers, ordered=False):
+    for annotation in annotations:
+        data = annotation.data
+        VOTES.setdefault(annotation.fragment, []).append(
+            {'annotator': data.annotator,
+             'unknown': data.unknown,
+             'known': dict(data.get('known', {}))})
+        MEDIUM[annotation.fragment] = medium
+
+# evaluate consensus of every shot
+print 'evaluating consensus of {n:d} shots'.format(n=len(VOTES))
+if processes > 1:
+    pool = Pool(processes)
+    outcomes = pool.imap_unordered(evaluate, VOTES.iteritems(), chunksize=100)
+else:
+    outcomes = (evaluate(item) for item in VOTES.iteritems())
+
+targetConsensus = {}
+targetUnknown = {}
+for shot, outcome in outcomes:
+    if outcome == 'unknown':
+        targetUnknown[shot] = None
+    elif outcome is not None:
+        targetConsensus[shot] = outcome
+
+if processes > 1:
+    pool.close()
+    pool.join()
+
+# compare with stored annotations and apply differences
+print 'loading consensus'
+applyDiff(consensusLayer, 'consensus',
+          loadStored(consensusLayer), targetConsensus)
+
+if noUnknownConsensus:
+    print 'loading unknown'
+    applyDiff(unknownLayer, 'unknown',
+              loadStored(unknownLayer), targetUnknown)
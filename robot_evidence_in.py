@@ -43,11 +43,19 @@ Options:
   --password=P45sw0Rd      Password
   --period=N               Query submission queue every N sec [default: 3600].
   --limit=N                Size of the queue [default: 1000].
+  --batch=N                Enqueue up to N items at once [default: 20].
   --log=DIR                Path to log directory.
+  --metrics                Export Camomile API metrics to log directory.
+  --profile                Log per-cycle timing of each phase.
+  --cprofile               Dump cProfile stats of the main thread to log
+                           directory.
+  --pool-size=N            HTTP connection pool size [default: 10].
+  --timeout=N              HTTP request timeout in seconds [default: 300].
+  --cache-dir=DIR          Path to local annotation mirror.
 
 """
 
-from common import RobotCamomile, create_logger
+from common import RobotCamomile, create_logger, create_profiler
 from docopt import docopt
 from time import sleep
 
@@ -57,14 +65,24 @@ url = arguments['--url']
 password = arguments['--password']
 period = int(arguments['--period'])
 limit = int(arguments['--limit'])
+batch = int(arguments['--batch'])
 
 debug = arguments['--debug']
 log = arguments['--log']
+metrics = ('{log}/robot_evidence_in.prom'.format(log=log)
+           if arguments['--metrics'] and log else None)
+poolSize = int(arguments['--pool-size'])
+timeout = float(arguments['--timeout'])
+cacheDir = arguments['--cache-dir']
 logger = create_logger('robot_evidence_in', path=log, debug=debug)
+profiler = create_profiler(
+    'robot_evidence_in', path=log, enabled=arguments['--profile'],
+    cprofile=arguments['--cprofile'])
 
 robot = RobotCamomile(
     url, 'robot_evidence', password=password,
-    period=period, logger=logger)
+    period=period, logger=logger, cache_dir=cacheDir,
+    pool_size=poolSize, timeout=timeout, metrics=metrics)
 
 # filled by this script and popped by evidence annotation front-end
 evidenceInQueue = robot.getQueueByName(
@@ -106,6 +124,11 @@ def update(numberOfEvidencesInQueue):
         if 'deleted' in evidenceLayer.description:
             continue
 
+        # skip submission layers still being copied by robot_submission
+        if ('copying' in evidenceLayer.description or
+                'id_label' not in evidenceLayer.description):
+            continue
+
         # skip if all evidences are already checked
         if 'annotationsComplete' in evidenceLayer.description:
             continue
@@ -174,6 +197,11 @@ def update(numberOfEvidencesInQueue):
         if 'deleted' in evidenceLayer.description:
             continue
 
+        # skip submission layers still being copied by robot_submission
+        if ('copying' in evidenceLayer.description or
+                'id_label' not in evidenceLayer.description):
+            continue
+
         # skip if all evidences are already checked
         if 'annotationsComplete' in evidenceLayer.description:
             continue
@@ -224,14 +252,21 @@ while True:
 
     # get a certain amount of new evidences to annotate
     # based on the current length of the queue
+    profiler.phase('update')
     newEvidences = update(robot.pickLength(evidenceInQueue))
 
-    # add (and log) all evidences, the one after the other
+    # log all evidences
+    profiler.phase('enqueue')
     for item in newEvidences:
         logger.info(
             "new evidence - {name:s} - {source:s}".format(
                 name=item['person_name'], source=item['source']))
 
-        robot.enqueue(evidenceInQueue, item)
+    # and add them by batches (update() already made sure that they fit
+    # in the queue: waiting for room here would delay next update())
+    robot.enqueue_fair_batch(evidenceInQueue, newEvidences, size=batch)
+
+    profiler.summary()
+    robot.exportMetrics()
 
     sleep(period)
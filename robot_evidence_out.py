@@ -42,11 +42,21 @@ Options:
                            [default: http://api.mediaeval.niderb.fr]
   --password=P45sw0Rd      Password
   --period=N               Query evidence queue every N sec [default: 600].
+  --batch=N                Dequeue up to N items at once [default: 1].
+  --min-wait=N             When queue is empty, wait N sec then twice as
+                           long, up to --period sec [default: 0.5].
   --log=DIR                Path to log directory.
+  --metrics                Export Camomile API metrics to log directory.
+  --profile                Log per-cycle timing of each phase.
+  --cprofile               Dump cProfile stats of the main thread to log
+                           directory.
+  --pool-size=N            HTTP connection pool size [default: 10].
+  --timeout=N              HTTP request timeout in seconds [default: 300].
+  --cache-dir=DIR          Path to local annotation mirror.
 
 """
 
-from common import RobotCamomile, create_logger
+from common import RobotCamomile, create_logger, create_profiler
 from docopt import docopt
 
 arguments = docopt(__doc__, version='0.1')
@@ -54,14 +64,26 @@ arguments = docopt(__doc__, version='0.1')
 url = arguments['--url']
 password = arguments['--password']
 period = int(arguments['--period'])
+batch = int(arguments['--batch'])
+minWait = float(arguments['--min-wait'])
 
 debug = arguments['--debug']
 log = arguments['--log']
+metrics = ('{log}/robot_evidence_out.prom'.format(log=log)
+           if arguments['--metrics'] and log else None)
+poolSize = int(arguments['--pool-size'])
+timeout = float(arguments['--timeout'])
+cacheDir = arguments['--cache-dir']
 logger = create_logger('robot_evidence_out', path=log, debug=debug)
+profiler = create_profiler(
+    'robot_evidence_out', path=log, enabled=arguments['--profile'],
+    cprofile=arguments['--cprofile'],
+    interval=period)
 
 robot = RobotCamomile(
     url, 'robot_evidence', password=password,
-    period=period, logger=logger)
+    period=period, logger=logger, cache_dir=cacheDir,
+    pool_size=poolSize, timeout=timeout, metrics=metrics)
 
 # filled by evidence annotation front-end
 evidenceOutQueue = robot.getQueueByName(
@@ -87,7 +109,12 @@ for _, evidences in robot.getAnnotations_iter(evidenceGroundtruthLayer):
         mapping[id_shot, person_name, source] = to
 
 # forever loop on evidence front-end output
-for item in robot.dequeue_loop(evidenceOutQueue):
+for item in profiler.cycles(robot.dequeue_loop(evidenceOutQueue,
+                                               batch=batch,
+                                               min_wait=minWait),
+                            'dequeue'):
+
+    profiler.phase('store')
 
     # front-end input
     id_shot = item.input.id_shot
@@ -136,6 +163,7 @@ for item in robot.dequeue_loop(evidenceOutQueue):
             "new evidence - {name:s} - {source:s}".format(
                 name=person_name, source=source))
 
+    profiler.phase('propagate')
     try:
         # propagate this evidence to the corresponding submission mapping
         description = robot.getLayer(id_submission).description
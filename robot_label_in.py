@@ -42,32 +42,54 @@ Options:
   --url=URL                 Camomile server URL
                             [default: http://api.mediaeval.niderb.fr]
   --password=P45sw0Rd       Password
-  --refresh=N               Refresh annotation status every N sec
-                            [default: 86400].
+  --refresh=N               Refresh annotation status of unchanged media
+                            every N sec anyway [default: 86400].
+  --mapping-period=N        Reload submission mappings and mugshots every
+                            N sec [default: 60].
   --period=N                Query label queue every N sec [default: 600].
   --limit=N                 Approximate maximum number of items in
                             label queue [default: 400].
+  --batch=N                 Enqueue up to N items at once [default: 20].
   --skip-empty              Put into the queue only shot with hypothesis
   --videos=PATH             List of video to process
   --other=N                 Number of alternative person names [default: 10]
   --log=DIR                 Path to log directory.
+  --metrics                 Export Camomile API metrics to log directory.
+  --profile                 Log per-cycle timing of each phase.
+  --cprofile                Dump cProfile stats of the main thread to log
+                            directory.
+  --pool-size=N             HTTP connection pool size [default: 10].
+  --timeout=N               HTTP request timeout in seconds [default: 300].
   --queue=NAME              Label incoming queue [default: mediaeval.label.in]
   --no-unknown-consensus    Stop looking for consensus when unknown
   --queries=list            Put into the queue only shot with hypothesis in the list of queries
+  --workers=N               Number of layers loaded in parallel [default: 1].
+  --prefetch=K              Refresh up to K upcoming media in background
+                            while enqueueing [default: 1].
+  --max-cached-media=N      Keep at most N media in memory (least recently
+                            refreshed ones are reloaded when needed).
+  --cache-mb=N              Keep cached media under N MB of memory.
 """
 
-from common import RobotCamomile, create_logger
+from common import RobotCamomile, LRUCache, threaded_imap
+from common import create_logger, create_profiler
+from shots import ShotAnnotationStore, ShotScheduler, NameIndex
+from shots import sliding_window_union
+from consensus import ShotVotes
 from docopt import docopt
 from datetime import datetime
 from random import sample
 
 emptyAtLaunch = True
 
-ANCHORS = set(["david_pujadas",
-               "beatrice_schonberg",
-               "laurent_delahousse",
-               "francoise_laborde"])
-UNKNOWN = '?unknown?'
+# sets of person names are stored as sets of interned name IDs
+NAMES = NameIndex()
+
+ANCHORS = NAMES.ids(["david_pujadas",
+                     "beatrice_schonberg",
+                     "laurent_delahousse",
+                     "francoise_laborde"])
+UNKNOWN = NAMES.ids(['?unknown?'])
 
 arguments = docopt(__doc__, version='0.1')
 
@@ -79,26 +101,39 @@ noUnknownConsensus = arguments['--no-unknown-consensus']
 # debugging and logging
 debug = arguments['--debug']
 log = arguments['--log']
+metrics = ('{log}/robot_label_in.prom'.format(log=log)
+           if arguments['--metrics'] and log else None)
+poolSize = int(arguments['--pool-size'])
+timeout = float(arguments['--timeout'])
 logger = create_logger('robot_label_in', path=log, debug=debug)
+profiler = create_profiler(
+    'robot_label_in', path=log, enabled=arguments['--profile'],
+    cprofile=arguments['--cprofile'])
 
-# how often to refresh annotation status
+# how often to refresh annotation status of unchanged media
 refresh = int(arguments['--refresh'])
 
+# how often to reload submission mappings and mugshots
+mappingPeriod = int(arguments['--mapping-period'])
+
 # how often to pick queue length
 period = int(arguments['--period'])
 
 # approximate maximum number of items in queue
 limit = int(arguments['--limit'])
 
+# maximum number of items pushed at once
+batch = int(arguments['--batch'])
+
 # put into the queue only shot with hypothesis
 skipEmpty = arguments['--skip-empty']
 
 # put into the queue only shot with hypothesis in the list of queries
 queries = False
+queryNames = set([])
 if arguments['--queries']:
-    queries = set([])
-    for line in open(arguments['--queries']).read().splitlines():
-        queries.add(line)
+    queryNames = set(open(arguments['--queries']).read().splitlines())
+    queries = NAMES.ids(queryNames)
 
 # only annotate those videos
 videos = arguments['--videos']
@@ -107,9 +142,24 @@ other = int(arguments['--other'])
 
 queueName = arguments['--queue']
 
+# number of submission layers loaded in parallel
+workers = int(arguments['--workers'])
+
+# number of media refreshed in background ahead of enqueueing
+prefetch = int(arguments['--prefetch'])
+
+# memory budget of per-medium cache
+maxCachedMedia = arguments['--max-cached-media']
+if maxCachedMedia:
+    maxCachedMedia = int(maxCachedMedia)
+cacheMB = arguments['--cache-mb']
+if cacheMB:
+    cacheMB = float(cacheMB)
+
 robot = RobotCamomile(
     url, 'robot_label', password=password,
-    period=period, logger=logger)
+    period=period, logger=logger,
+    pool_size=poolSize, timeout=timeout, metrics=metrics)
 
 # test corpus
 test = robot.getCorpusByName('mediaeval.test')
@@ -148,29 +198,79 @@ if videos:
 else:
     media = media.values()
 
+def getLayerMapping():
+
+    # mapping of all existing label layers, in one request
+    layerMapping = {}
+    for layer in robot.getLayers(test,
+                                 data_type='mediaeval.persondiscovery.label'):
+
+        # skip original submission layers
+        if 'copy' not in layer.description:
+            continue
+
+        # skip deleted submission layers
+        if 'deleted' in layer.description:
+            continue
+
+        # skip submission layers still being copied by robot_submission
+        if 'copying' in layer.description:
+            continue
+
+        # default to empty mapping
+        layerMapping[layer._id] = layer.description.get('mapping', {})
+
+    return layerMapping
+
 logger.info('load mapping of all existing label layers')
 
 # load mapping of all existing label layers
-LAYER_MAPPING = {}
-for layer in robot.getLayers(test,
-                             data_type='mediaeval.persondiscovery.label'):
+LAYER_MAPPING = getLayerMapping()
+
+# set of person name with a mugshot
+PERSON_NAME_WITH_MUGSHOT = set([])
+
+# incremented whenever LAYER_MAPPING or PERSON_NAME_WITH_MUGSHOT change
+MAPPING_VERSION = {'global': 0}
+
+# time of last reload of LAYER_MAPPING and PERSON_NAME_WITH_MUGSHOT
+MAPPING_LOADED = None
+
+def refreshMapping():
+
+    # only called by update(), hence by the thread refreshing media:
+    # a medium is never (pre)loaded with an outdated set of layers
+    global LAYER_MAPPING, PERSON_NAME_WITH_MUGSHOT, MAPPING_LOADED
 
-    # skip original submission layers
-    if 'copy' not in layer.description:
-        continue
+    # reload at most every mappingPeriod seconds
+    now = datetime.now()
+    if (MAPPING_LOADED is not None and
+            (now - MAPPING_LOADED).total_seconds() < mappingPeriod):
+        return
+    MAPPING_LOADED = now
 
-    # skip deleted submission layers
-    if 'deleted' in layer.description:
-        continue
+    layerMapping = getLayerMapping()
+
+    logger.info('refresh - loading person names with mugshot')
+
+    personNameWithMugshot = set(
+        robot.getLayer(mugshotLayer).description.mugshots.keys())
 
-    # default to empty mapping
-    LAYER_MAPPING[layer._id] = layer.description.get('mapping', {})
+    # nothing changed
+    if (MAPPING_VERSION['global'] > 0 and
+        layerMapping == LAYER_MAPPING and
+        personNameWithMugshot == PERSON_NAME_WITH_MUGSHOT):
+        return
 
-LOADED = {}
-SUBMISSION_SHOTS = {}
-SORTED_SUBMISSION_SHOTS = {}
-SHOTS = {}
-ANNOTATION_HYPOTHESES = {}
+    # submission layers were added or deleted:
+    # hypotheses of every medium need to be loaded again
+    if set(layerMapping) != set(LAYER_MAPPING):
+        logger.info('refresh - submission layers changed')
+        MEDIA.clear()
+
+    LAYER_MAPPING = layerMapping
+    PERSON_NAME_WITH_MUGSHOT = personNameWithMugshot
+    MAPPING_VERSION['global'] += 1
 
 def loadOnDemand(medium):
 
@@ -178,100 +278,220 @@ def loadOnDemand(medium):
     # as {id: details} dictionary
     logger.info('loading submission shots')
 
-    SUBMISSION_SHOTS[medium] = {}
+    submissionShots = {}
     for shot in robot.getAnnotations(submissionShotLayer, medium=medium):
-        SUBMISSION_SHOTS[medium][shot._id] = {
+        submissionShots[shot._id] = {
             'id_medium': shot.id_medium,
             'start': shot.fragment.segment.start,
             'end': shot.fragment.segment.end}
 
-    # sort SUBMISSION_SHOTS by medium and chronologically
-    SORTED_SUBMISSION_SHOTS[medium] = sorted(
-        SUBMISSION_SHOTS[medium],
-        key=lambda s: (SUBMISSION_SHOTS[medium][s]['start']))
+    # sort submission shots chronologically
+    sortedSubmissionShots = sorted(
+        submissionShots, key=lambda s: (submissionShots[s]['start']))
 
     # subset of submission shots
-    SHOTS[medium] = set([s for s, d in SUBMISSION_SHOTS[medium].iteritems()
-                         if d['id_medium'] == medium])
+    shots = set([s for s, d in submissionShots.iteritems()
+                 if d['id_medium'] == medium])
 
     logger.info('hypotheses')
 
     # get hypothesis person names
-    ANNOTATION_HYPOTHESES[medium] = {}
-    for layer in LAYER_MAPPING:
+    annotationHypotheses = {}
+
+    # inverted index: shots where each person name is hypothesized
+    shotsByName = {}
+
+    def getLayerAnnotations(layer):
         logger.debug('hypotheses - medium = {medium} / layer = {layer}'.format(
             medium=medium, layer=layer))
-        ANNOTATION_HYPOTHESES[medium][layer] = {}
-        for shot in SUBMISSION_SHOTS[medium]:
-            ANNOTATION_HYPOTHESES[medium][layer][shot] = set([])
-        for a in robot.getAnnotations(layer=layer, medium=medium):
-            ANNOTATION_HYPOTHESES[medium][layer][a.fragment].add(a.data.person_name)
-
-    LOADED[medium] = True
+        return robot.getAnnotations(layer=layer, medium=medium)
+
+    for layer, annotations in threaded_imap(
+            getLayerAnnotations, list(LAYER_MAPPING),
+            workers=workers, ordered=False):
+        # shots without hypothesis are left out
+        annotationHypotheses[layer] = {}
+        for a in annotations:
+            annotationHypotheses[layer][a.fragment] = (
+                annotationHypotheses[layer].get(a.fragment, NAMES.EMPTY) |
+                NAMES.ids([a.data.person_name]))
+        shotsByName[layer] = {}
+        for a in annotations:
+            shotsByName[layer].setdefault(
+                a.data.person_name, set([])).add(a.fragment)
+
+    return {'submissionShots': submissionShots,
+            'sortedSubmissionShots': sortedSubmissionShots,
+            'shots': shots,
+            'annotationHypotheses': annotationHypotheses,
+            'shotsByName': shotsByName,
+            # state as of last refresh
+            'state': None}
+
+# per-medium data, loaded on demand and evicted when memory budget is exceeded
+MEDIA = LRUCache(loadOnDemand, max_items=maxCachedMedia, max_mb=cacheMB)
+
+def mappingVersion(medium):
+
+    # mapping and mugshots did not change at all since last time
+    state = MEDIA[medium]['state'] or {}
+    globalVersion, version = state.get('mapping', (None, None))
+    if globalVersion == MAPPING_VERSION['global']:
+        return globalVersion, version
+
+    # only look at person names hypothesized in this medium
+    mapped = set([])
+    for layer, mapping in LAYER_MAPPING.iteritems():
+        for personName in MEDIA[medium]['shotsByName'].get(layer, {}):
+            correctedPersonName = mapping.get(personName, None)
+            mapped.add((layer, personName, correctedPersonName,
+                        correctedPersonName in PERSON_NAME_WITH_MUGSHOT))
+
+    return MAPPING_VERSION['global'], hash(frozenset(mapped))
+
+def annotationsVersion(*annotationsByLayer):
+
+    # robots replace annotations rather than update them: sets of
+    # annotation IDs are enough to detect changes
+    return tuple(hash(tuple(sorted(annotation._id
+                                   for annotation in annotations)))
+                 for annotations in annotationsByLayer)
+
+def candidateShots(cached, allAnnotations):
+
+    candidates = set([])
+
+    # shots where a query has already been annotated
+    for personName in queryNames:
+        candidates.update(allAnnotations.shots_with(personName))
+
+    # shots where a submission hypothesis is mapped to a query
+    for layer, mapping in LAYER_MAPPING.iteritems():
+        for personName, shots in cached['shotsByName'].get(
+                layer, {}).iteritems():
+            if mapping.get(personName, None) in queryNames:
+                candidates.update(shots)
+
+    # and their neighbours, whose hypotheses end up in "others"
+    sortedShots = cached['sortedSubmissionShots']
+    n = len(sortedShots)
+    neighbours = set([])
+    for i, shot in enumerate(sortedShots):
+        if shot in candidates:
+            neighbours.update(sortedShots[max(i - other, 0):min(i + other, n)])
+
+    return neighbours
 
 def update(medium):
 
-    # load on demand (done only once)
-    if medium not in LOADED:
-        loadOnDemand(medium)
+    now = datetime.now()
+
+    # update layer mapping (every mappingPeriod seconds, as a pass over all
+    # media may take hours when the queue is full). this is done by the
+    # thread refreshing media, so that media are never loaded meanwhile.
+    profiler.phase('load mapping')
+    refreshMapping()
+
+    # load on demand (done again if evicted from cache)
+    if medium not in MEDIA:
+        profiler.phase('load on demand')
+    cached = MEDIA[medium]
+
+    profiler.phase('detect changes')
+
+    # fetched before annotations so that changes happening
+    # during this refresh are detected next time
+    currentMapping = mappingVersion(medium)
+
+    # annotations are downloaded once, both to detect changes and (if any)
+    # to rebuild hypotheses
+    consensusAnnotations = robot.getAnnotations(consensusLayer, medium=medium)
+    unknownAnnotations = []
+    if noUnknownConsensus:
+        unknownAnnotations = robot.getAnnotations(unknownLayer, medium=medium)
+    allAnnotations = robot.getAnnotations(layer=allLayer, medium=medium)
+    currentAnnotations = annotationsVersion(
+        consensusAnnotations, unknownAnnotations, allAnnotations)
+
+    # skip media for which nothing changed since last refresh
+    state = cached['state']
+    if (state is not None and
+        state['mapping'][1] == currentMapping[1] and
+        state['annotations'] == currentAnnotations and
+        (datetime.now() - state['time']).total_seconds() < refresh):
+
+        # no need to go through mapping again next time
+        state['mapping'] = currentMapping
+
+        logger.info('refresh - medium {medium} did not change'.format(
+            medium=medium))
+        profiler.phase(None)
+        return cached
 
+    profiler.phase('load consensus')
     logger.info('refresh - loading consensus shots')
 
     # shots for which a consensus has already been reached
     shotWithConsensus = {}
-    for annotation in robot.getAnnotations(consensusLayer, medium=medium):
+    for annotation in consensusAnnotations:
         data = annotation.get('data', {})
         # HACK - data might be u'' - I don't know why
         if not data:
             data = {}
-        shotWithConsensus[annotation.fragment] = set(data)
+        shotWithConsensus[annotation.fragment] = NAMES.ids(data)
 
     # shots for which a unknown has been annotated
     shotWithUnknown = set([])
     if noUnknownConsensus:
-        for annotation in robot.getAnnotations(unknownLayer, medium=medium):
+        for annotation in unknownAnnotations:
             shotWithUnknown.add(annotation.fragment)
 
     # shots for which we are still missing annotations
     # in order to reach a consensus
-    remainingShots = SHOTS[medium]
+    remainingShots = cached['shots']
     remainingShots -= set(shotWithConsensus.keys())
     remainingShots -= shotWithUnknown
 
-    # update layer mapping
-    for layer in LAYER_MAPPING:
-        LAYER_MAPPING[layer] = robot.getLayer(layer).description.get('mapping', {})
-
-    logger.info('refresh - loading person names with mugshot')
-
-    # set of person name with a mugshot
-    personNameWithMugshot = set(
-        robot.getLayer(mugshotLayer).description.mugshots.keys())
-
+    profiler.phase('build hypotheses')
     logger.info('refresh - building hypothesis for remaining shots')
 
 
     hypotheses = {}
     annotators = {}
 
-    allAnnotations = robot.getAnnotations(layer=allLayer, medium=medium)
+    # number of person names annotators disagree on
+    # (only for shots annotated by at least two of them)
+    disagreements = {}
+
+    # index all annotations of this medium by shot (in one pass)
+    allAnnotations = ShotAnnotationStore(allAnnotations)
+
+    # only look at shots that may end up in the queue
+    # (or in the "others" of those)
+    if queries:
+        remainingShots = remainingShots & candidateShots(
+            cached, allAnnotations)
 
     for shot in remainingShots:
-        hypotheses[shot] = set([])
-        annotators[shot] = set([])
 
-        for annotation in [a for a in allAnnotations if a.fragment == shot]:
-            # get set of all hypothesis already annotated
-            hypotheses[shot].update(
-                set(annotation.data.get('known', {}).keys()))
+        # get set of all hypothesis already annotated
+        hypotheses[shot] = NAMES.ids(allAnnotations.known(shot))
+
+        # get set of users who already annotated this shot
+        annotators[shot] = set(allAnnotations.annotators(shot))
 
-            # get set of users who already annotated this shot
-            annotators[shot] = set([annotation.data.annotator])
+        if len(annotators[shot]) > 1:
+            n = ShotVotes(annotation.data for annotation
+                          in allAnnotations.annotations(shot)).disagreements()
+            if n:
+                disagreements[shot] = n
 
         skip_shot = False
         for layer, mapping in LAYER_MAPPING.iteritems():
 
-            for hypothesizedPersonName in ANNOTATION_HYPOTHESES[medium][layer][shot]:
+            for hypothesizedPersonName in NAMES.names(
+                    cached['annotationHypotheses'].get(layer, {}).get(
+                        shot, NAMES.EMPTY)):
 
                 # find how the hypothesized name was mapped
                 correctedPersonName = mapping.get(hypothesizedPersonName, None)
@@ -293,7 +513,7 @@ def update(medium):
 
                 # in case the mapped person name does not have a mugshot yet
                 # skip this shot entirely
-                if correctedPersonName not in personNameWithMugshot:
+                if correctedPersonName not in PERSON_NAME_WITH_MUGSHOT:
                     logger.info(
                         'refresh - skipping shot {shot} because no mugshot '
                         'is available for {name}.'.format(
@@ -301,7 +521,7 @@ def update(medium):
                     skip_shot = True
                     break
 
-                hypotheses[shot].add(correctedPersonName)
+                hypotheses[shot] |= NAMES.ids([correctedPersonName])
 
             if skip_shot:
                 break
@@ -309,79 +529,220 @@ def update(medium):
         if skip_shot:
             del hypotheses[shot]
             del annotators[shot]
+            disagreements.pop(shot, None)
 
+    profiler.phase('gather others')
     logger.info('refresh - gathering alternative hypotheses')
 
-    others = {}
-
-    for shot in hypotheses:
-        others[shot] = set([])
+    def names(shot):
+        return (shotWithConsensus.get(shot, NAMES.EMPTY) |
+                hypotheses.get(shot, NAMES.EMPTY))
 
-        i = SORTED_SUBMISSION_SHOTS[medium].index(shot)
-        n = len(SORTED_SUBMISSION_SHOTS[medium])
-        nearShots = SORTED_SUBMISSION_SHOTS[medium][max(i - other, 0):
-                                                  min(i + other, n)]
+    # one sweep over chronologically sorted shots
+    others = {}
+    for shot, nearNames in sliding_window_union(
+            cached['sortedSubmissionShots'], names, other, other):
 
-        others[shot].update(ANCHORS)
-        for nearShot in nearShots:
-            others[shot].update(
-                shotWithConsensus.get(nearShot, set([])))
+        if shot not in hypotheses:
+            continue
 
-            others[shot].update(
-                hypotheses.get(nearShot, set([])))
+        others[shot] = nearNames | ANCHORS
 
         # remove person already in hypotheses
         others[shot] -= hypotheses[shot]
 
         # remove ?unknown?
-        others[shot] -= set([UNKNOWN])
+        others[shot] -= UNKNOWN
+
+    cached['state'] = {'time': datetime.now(),
+                       'mapping': currentMapping,
+                       'annotations': currentAnnotations,
+                       'hypotheses': hypotheses,
+                       'others': others,
+                       'annotators': annotators,
+                       'disagreements': disagreements}
+    MEDIA.resize(medium)
+    profiler.phase(None)
+
+    t = datetime.now()
+    logger.info('refresh - medium {medium} finished in {seconds:d} seconds'.format(
+        medium=medium, seconds=int((t - now).total_seconds())))
+
+    return cached
+
+
+
+def rank(shot, state, annotationHypotheses):
+
+    hypotheses = state['hypotheses']
+    annotators = state['annotators']
+
+    # consensus needs at least two annotators: shots that are one vote
+    # away from it (or were annotated but do not agree yet) come first
+    missingVotes = max(2 - len(annotators[shot]), 1)
+
+    # among those, shots whose annotators agree on more person names
+    disagreements = state['disagreements'].get(shot, 0)
+
+    # then shots blocking the evaluation of more submissions
+    submissions = sum(
+        1 for hypothesizedPersonNames
+        in annotationHypotheses.itervalues()
+        if shot in hypothesizedPersonNames)
+
+    # then shots covering more queries
+    coveredQueries = len(hypotheses[shot] & queries) if queries else 0
+
+    return missingVotes, disagreements, -submissions, -coveredQueries
+
+
+def queueShots(cached):
+
+    # state may be replaced by the refreshing thread meanwhile:
+    # rank all shots against the same snapshot
+    state = cached['state']
+    hypotheses = state['hypotheses']
+
+    for shot in cached['sortedSubmissionShots']:
+
+        # shot was skipped
+        if shot not in hypotheses:
+            continue
+
+        # do not annotate a shot if there is no hypothesis
+        if not hypotheses[shot] and skipEmpty:
+            continue
+
+        if queries and not hypotheses[shot] & queries:
+            continue
+
+        yield rank(shot, state, cached['annotationHypotheses']), shot
+
+
+def queueItem(medium, shot):
+
+    # medium was evicted from cache since this shot was scheduled:
+    # its shots will be scheduled again next time it is refreshed
+    cached = MEDIA.peek(medium)
+    state = None if cached is None else cached['state']
+    if state is None:
+        return None
+
+    hypotheses = state['hypotheses']
+    others = state['others']
+    annotators = state['annotators']
+
+    if shot not in hypotheses:
+        return None
+
+    item = {}
+    item['id_shot'] = shot
+    item['id_medium'] = cached['submissionShots'][shot]['id_medium']
+    item['start'] = cached['submissionShots'][shot]['start'] + 0.5
+    item['end'] = cached['submissionShots'][shot]['end'] - 0.5
+    item['hypothesis'] = NAMES.names(hypotheses[shot])
+    item['others'] = NAMES.names(others[shot])
+    item['annotated_by'] = list(annotators[shot])
+
+    logger.debug('new annotation for shot {shot}'.format(
+        shot=shot))
+
+    return item
+
+
+# shots currently in label queue
+# (as of last inspection, plus those pushed since then)
+IN_QUEUE = set([])
+
+# time of last inspection of label queue
+QUEUE_INSPECTED = None
+
+def isStale(item):
+
+    # shot no longer needs annotations as of last refresh of its medium
+    # (e.g. it has reached a consensus or was annotated as unknown)
+    # media that are not cached are not loaded again just for that
+    cached = MEDIA.peek(item.get('id_medium', None))
+    state = None if cached is None else cached['state']
+    if state is None:
+        return False
+    return item.get('id_shot') not in state['hypotheses']
+
+def inspectQueue():
+
+    global IN_QUEUE, QUEUE_INSPECTED
+
+    # the whole queue is rewritten when purged, which may race with the
+    # front-end popping items: only inspect it every `period` seconds
+    now = datetime.now()
+    if (QUEUE_INSPECTED is not None and
+            (now - QUEUE_INSPECTED).total_seconds() < period):
+        return
+    QUEUE_INSPECTED = now
+
+    items = robot.pickAll(labelInQueue)
+
+    # remove duplicate and stale items
+    inQueue = set([])
+    kept = []
+    for item in items:
+        shot = item.get('id_shot', None)
+        if shot in inQueue or isStale(item):
+            continue
+        inQueue.add(shot)
+        kept.append(item)
+
+    if len(kept) < len(items):
+        logger.info('purge - removing {n:d} items from label queue'.format(
+            n=len(items) - len(kept)))
+        robot.updateQueue(labelInQueue, elements=kept)
 
-    return hypotheses, others, annotators
+    IN_QUEUE = inQueue
 
+def notInQueue(items):
 
+    for item in items:
 
-while True:
+        # already in queue
+        if item['id_shot'] in IN_QUEUE:
+            continue
 
-    # randomize media order
-    for medium in sample(media, len(media)):
+        IN_QUEUE.add(item['id_shot'])
+        yield item
 
-        # only refresh this medium
-        now = datetime.now()
-        hypotheses, others, annotators = update(medium)
-        t = datetime.now()
+def mediaOrder():
 
-        logger.info('refresh - medium {medium} finished in {seconds:d} seconds'.format(
-            medium=medium, seconds=int((t - now).total_seconds())))
+    while True:
 
-        for shot in SORTED_SUBMISSION_SHOTS[medium]:
+        # randomize media order
+        for medium in sample(media, len(media)):
+            yield medium
 
-            # shot was skipped
-            if shot not in hypotheses:
-                continue
+# pending shots of all media (items are built when popped)
+scheduler = ShotScheduler(queueItem)
 
-            # do not annotate a shot if there is no hypothesis
-            if hypotheses[shot] == set([]) and skipEmpty:
-                continue
+# refresh upcoming media in background while enqueueing the current one
+for medium, cached in threaded_imap(
+        update, mediaOrder(),
+        workers=1, window=prefetch + 1 if prefetch else None):
 
-            if queries and not hypotheses[shot].intersection(queries):
-                continue
+    profiler.phase('schedule')
+    n = scheduler.update(medium, queueShots(cached))
 
-            item = {}
-            item['id_shot'] = shot
-            item['id_medium'] = SUBMISSION_SHOTS[medium][shot]['id_medium']
-            item['start'] = SUBMISSION_SHOTS[medium][shot]['start'] + 0.5
-            item['end'] = SUBMISSION_SHOTS[medium][shot]['end'] - 0.5
-            item['hypothesis'] = list(hypotheses[shot])
-            item['others'] = list(others[shot])
-            item['annotated_by'] = list(annotators[shot])
+    # empty queue at launch time
+    if emptyAtLaunch and n:
+        robot.updateQueue(labelInQueue, elements=[])
+        emptyAtLaunch = False
 
-            logger.debug('new annotation for shot {shot}'.format(
-                shot=shot))
+    # keep track of shots already in queue, and purge outdated ones
+    profiler.phase('inspect queue')
+    inspectQueue()
 
-            # empty queue at launch time
-            if emptyAtLaunch:
-                robot.updateQueue(labelInQueue, elements=[])
-                emptyAtLaunch = False
+    # push as many shots as this medium brought in,
+    # but pick the most promising ones among all media
+    profiler.phase('enqueue')
+    robot.enqueue_fair_batch(
+        labelInQueue, notInQueue(scheduler.pop(n)), limit=limit, size=batch)
 
-            robot.enqueue_fair(labelInQueue, item, limit=limit)
-            
\ No newline at end of file
+    profiler.summary()
+    robot.exportMetrics()
@@ -42,29 +42,53 @@ Options:
                            [default: http://api.mediaeval.niderb.fr]
   --password=P45sw0Rd      Password
   --period=N               Query evidence queue every N sec [default: 600].
+  --batch=N                Dequeue up to N items at once, and save their
+                           votes and consensus in bulk [default: 1].
+  --min-wait=N             When queue is empty, wait N sec then twice as
+                           long, up to --period sec [default: 0.5].
   --log=DIR                Path to log directory.
+  --metrics                Export Camomile API metrics to log directory.
+  --profile                Log per-cycle timing of each phase.
+  --cprofile               Dump cProfile stats of the main thread to log
+                           directory.
+  --pool-size=N            HTTP connection pool size [default: 10].
+  --timeout=N              HTTP request timeout in seconds [default: 300].
   --no-unknown-consensus   Stop looking for consensus when unknown
+  --workers=N              Split each batch by shot between N threads
+                           processing them in parallel [default: 1].
 """
 
-from common import RobotCamomile, create_logger
+from common import RobotCamomile, create_logger, create_profiler
+from common import threaded_imap
+from consensus import ShotVotes
 from docopt import docopt
-from pandas import DataFrame
-
-UNKNOWN = '?unknown?'
+from collections import OrderedDict
 
 arguments = docopt(__doc__, version='0.1')
 
 url = arguments['--url']
 password = arguments['--password']
 period = int(arguments['--period'])
+batch = int(arguments['--batch'])
+minWait = float(arguments['--min-wait'])
 noUnknownConsensus = arguments['--no-unknown-consensus']
+workers = int(arguments['--workers'])
 
 debug = arguments['--debug']
 log = arguments['--log']
+metrics = ('{log}/robot_label_out.prom'.format(log=log)
+           if arguments['--metrics'] and log else None)
+poolSize = int(arguments['--pool-size'])
+timeout = float(arguments['--timeout'])
 logger = create_logger('robot_label_out', path=log, debug=debug)
+profiler = create_profiler(
+    'robot_label_out', path=log, enabled=arguments['--profile'],
+    cprofile=arguments['--cprofile'],
+    interval=period)
 robot = RobotCamomile(
     url, 'robot_label', password=password,
-    period=period, logger=logger)
+    period=period, logger=logger,
+    pool_size=poolSize, timeout=timeout, metrics=metrics)
 
 # corpus id
 test = robot.getCorpusByName('mediaeval.test')
@@ -85,152 +109,150 @@ allLayer = robot.getLayerByName(
 labelOutQueue = robot.getQueueByName(
     'mediaeval.label.out')
 
-for item in robot.dequeue_loop(labelOutQueue):
 
-    # save raw annotation
+def saveOutcomes(layer, outcomes, newOutcomes):
+    """Make new data the only annotation of each shot in `layer`
+
+    `outcomes` maps shots to ([annotation IDs], data) as stored in `layer`
+    and `newOutcomes` maps shots to (medium, data). Shots for which data is
+    already stored are left untouched. New annotations are created in one
+    request. Returns the list of shots whose annotations were written.
+    """
+
+    def unchanged(shot, data):
+        annotations, stored = outcomes.get(shot, ([], None))
+        return len(annotations) == 1 and stored == data
+
+    shots = [shot for shot, (_, data) in newOutcomes.iteritems()
+             if not unchanged(shot, data)]
+    if not shots:
+        return shots
+
+    # create new ones
+    annotations = robot.createAnnotations(
+        layer, [{'id_medium': newOutcomes[shot][0],
+                 'fragment': shot,
+                 'data': newOutcomes[shot][1]} for shot in shots],
+        returns_id=True)
 
-    shot = item.input.id_shot
-    medium = item.input.id_medium
-    known = item.output.known
-    unknown = item.output.unknown
-    annotator = item.log.user
+    # remove old ones (that might have been deleted by rebuild_consensus)
+    robot.deleteAnnotations(
+        [oldAnnotation for shot in shots
+         for oldAnnotation in outcomes.get(shot, ([], None))[0]],
+        ignore_missing=True)
 
-    robot.createAnnotation(
-        allLayer,
-        medium=medium, fragment=shot,
-        data={"known": known,
-              "unknown": unknown,
-              "annotator": annotator,
-              "log": item.get('log', {})})
+    for shot, annotation in zip(shots, annotations):
+        outcomes[shot] = ([annotation], newOutcomes[shot][1])
+
+    return shots
+
+
+def loadOutcomes(layer):
+
+    # shot --> ([annotation IDs], data of last annotation)
+    outcomes = {}
+    for _, annotations in robot.getAnnotations_iter(layer):
+        for annotation in annotations:
+            ids, _ = outcomes.get(annotation.fragment, ([], None))
+            # HACK - data might be u'' (and is None for unknown layer)
+            data = annotation.get('data', None) or None
+            outcomes[annotation.fragment] = (ids + [annotation._id], data)
 
-    # check new consensus for this shot
+    return outcomes
 
-    annotations = robot.getAnnotations(layer=allLayer, fragment=shot)
 
-    # start by gathering all person names
-    personNames = set([])
+# votes of every shot, kept up to date with the votes saved by this robot
+logger.info('loading votes')
+VOTES = {}
+for _, annotations in robot.getAnnotations_iter(allLayer):
     for annotation in annotations:
-        personNames.update(annotation.data.get('known', {}))
-
-    # create an annotator x personName table
-    df = DataFrame(columns=personNames.union(set([UNKNOWN])))
-
-    # fill this table...
-    for a, annotation in enumerate(annotations):
-
-        # get annotator login
-        annotator = annotation.data.annotator
-
-        # store whether annotator found an unknown speaking face
-        unknown = annotation.data.unknown
-        df.at[annotator, UNKNOWN] = 'speakingFace' if unknown else 'noFace'
-
-        # store known annotation
-        known = annotation.data.get('known', {})
-        for personName in personNames:
-            # if the annotator annotated this personName
-            # then we use his/her decision.
-            # if s/he did not annotate this personName
-            #  - we choose 'dontKnow' if s/he marked someone as unknown
-            #  - we choose 'noFace' if s/he did not mark anyone as unknown
-            status = known.get(personName,
-                               'dontKnow' if unknown else 'noFace')
-            df.at[annotator, personName] = status
-
-    if noUnknownConsensus and df[UNKNOWN].value_counts().get('speakingFace', 0) > 0:
-
-        # get previously existing unknown
-        annotations = robot.getAnnotations(layer=unknownLayer,
-                                           fragment=shot,
-                                           returns_id=True)
-        # create a new one
-        robot.createAnnotation(unknownLayer,
-                               medium=medium, fragment=shot,
-                               data=None, returns_id=True)
+        VOTES.setdefault(
+            annotation.fragment, ShotVotes()).add(annotation.data)
+
+# consensus and unknown annotations, kept up to date in the same way
+logger.info('loading consensus')
+CONSENSUS = loadOutcomes(consensusLayer)
+UNKNOWNS = loadOutcomes(unknownLayer)
+
+def process(items):
+
+    # save raw annotations (in one request)
+    profiler.phase('save votes')
+
+    # shots touched by this batch, as {shot: medium}
+    shots = OrderedDict()
+
+    annotations = []
+    for item in items:
+
+        shot = item.input.id_shot
+        medium = item.input.id_medium
+        known = item.output.known
+        unknown = item.output.unknown
+        annotator = item.log.user
+
+        vote = {"known": known,
+                "unknown": unknown,
+                "annotator": annotator}
+
+        annotations.append({'id_medium': medium,
+                            'fragment': shot,
+                            'data': dict(vote, log=item.get('log', {}))})
+
+        VOTES.setdefault(shot, ShotVotes()).add(vote)
+        shots[shot] = medium
+
+    robot.createAnnotations(allLayer, annotations, returns_id=True)
+
+    # check new consensus for touched shots (once per shot)
+    profiler.phase('consensus')
+
+    newUnknown = {}
+    newConsensus = {}
+
+    for shot, medium in shots.iteritems():
+
+        votes = VOTES[shot]
+
+        if noUnknownConsensus and votes.has_unknown():
+            newUnknown[shot] = (medium, None)
+            continue
+
+        consensus, reason = votes.consensus()
+        if consensus is None:
+            logger.debug("no consensus for shot {s} - {r}".format(
+                s=shot, r=reason))
+            continue
+
+        newConsensus[shot] = (medium, consensus)
+
+    # replace outdated unknown and consensus annotations
+    profiler.phase('update consensus')
+
+    for shot in saveOutcomes(unknownLayer, UNKNOWNS, newUnknown):
         logger.info('found unknown in shot {shot}'.format(shot=shot))
 
-        # delete old ones
-        for annotation in annotations:
-            robot.deleteAnnotation(annotation)
-
-        continue
-
-    # no consensus until we have at least 2 annotators
-    nAnnotators = len(df)
-    if nAnnotators < 2:
-        logger.debug(
-            "no consensus for shot {shot} - "
-            "only {n} annotators".format(
-                shot=shot, n=nAnnotators))
-        continue
-
-    consensus = {}
-    hasConsensus = True
-    for personName in df:
-
-        counts = df[personName].value_counts()
-
-        # no consensus if the count of expressed status
-        # (ie not 'dontKnow') is smaller than 2
-        expressedCounts = sum(count for status, count in counts.iteritems()
-                              if status != 'dontKnow')
-        if expressedCounts < 2:
-            hasConsensus = False
-            logger.debug(
-                "no consensus for shot {s} - "
-                "only {n} expressed annotation(s) for {p} ".format(
-                    s=shot, n=expressedCounts, p=personName))
-            break
-
-        # no consensus if the most frequent is 'dontKnow'
-        status = counts.argmax()
-        if status == 'dontKnow':
-            hasConsensus = False
-            logger.debug(
-                "no consensus for shot {s} - "
-                "most frequent state for {p} is 'dontKnow'".format(
-                    s=shot, p=personName))
-            break
-
-        # no consensus if the highest frequency is < 2
-        count = counts.max()
-        if count < 2:
-            hasConsensus = False
-            logger.debug(
-                "no consensus for shot {s} - "
-                "most frequent state for {p} only has {n} vote(s)".format(
-                    s=shot, p=personName, n=count))
-            break
-
-        # consensus if the most frequent is
-        # strictly more frequent than 50%
-        ratio = count / float(expressedCounts)
-        if ratio > 0.5:
-            consensus[personName] = status
-        else:
-            hasConsensus = False
-            logger.debug(
-                "no consensus for shot {s} - "
-                "most frequent state for {p} does not "
-                "have majority ({r:d}%)".format(
-                    s=shot, p=personName, r=int(100 * ratio)))
-            break
-
-    # found consensus
-    if hasConsensus:
-
-        # get previously existing consensus
-        annotations = robot.getAnnotations(layer=consensusLayer,
-                                           fragment=shot,
-                                           returns_id=True)
-
-        # create new one
-        robot.createAnnotation(
-            consensusLayer,
-            medium=medium, fragment=shot,
-            data=consensus, returns_id=True)
+    for shot in saveOutcomes(consensusLayer, CONSENSUS, newConsensus):
         logger.info("found consensus for shot {s}".format(s=shot))
 
-        # remove old ones
-        for annotation in annotations:
-            robot.deleteAnnotation(annotation)
+    profiler.phase(None)
+
+
+def shard(items):
+
+    # route items by shot, so that all votes for a shot
+    # are processed by the same worker (in order)
+    shards = [[] for _ in range(workers)]
+    for item in items:
+        shards[hash(item.input.id_shot) % workers].append(item)
+    return [shardItems for shardItems in shards if shardItems]
+
+
+for items in profiler.cycles(robot.dequeue_batches(labelOutQueue,
+                                                   size=batch,
+                                                   min_wait=minWait),
+                             'dequeue'):
+
+    for _ in threaded_imap(process, shard(items),
+                           workers=workers, ordered=False):
+        pass
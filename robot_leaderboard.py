@@ -43,10 +43,18 @@ Options:
   --password=P45sw0Rd        Password
   --period=N                 Query evidence queue every N sec [default: 6000].
   --log=DIR                  Path to log directory.
+  --metrics                  Export Camomile API metrics to log directory.
+  --profile                  Log per-cycle timing of each phase.
+  --cprofile                 Dump cProfile stats of the main thread to log
+                             directory.
+  --pool-size=N              HTTP connection pool size [default: 10].
+  --timeout=N                HTTP request timeout in seconds [default: 300].
   --levenshtein=<threshold>  Levenshtein ratio threshold [default: 0.95]
+  --cache-dir=DIR            Path to local annotation mirror.
+  --workers=N                Number of media loaded in parallel [default: 1].
 """
 
-from common import RobotCamomile, create_logger
+from common import RobotCamomile, create_logger, create_profiler
 from docopt import docopt
 from time import sleep
 from Levenshtein import ratio
@@ -74,12 +82,14 @@ def computeAveragePrecision(returned, relevant):
     return ap
 
 
-def computeMeanAveragePrecision(robot, layer, media, shots, qRelevant):
+def computeMeanAveragePrecision(robot, layer, media, shots, qRelevant,
+                                workers=1):
 
     # load submission
     qReturned = []
-    for medium in media:
-        for annotation in robot.getAnnotations(layer=layer, medium=medium):
+    for _, annotations in robot.getAnnotations_iter(
+            layer, media=media, workers=workers, ordered=False):
+        for annotation in annotations:
             shot = annotation.fragment
             if shot not in shots:
                 continue
@@ -110,12 +120,22 @@ password = arguments['--password']
 period = int(arguments['--period'])
 debug = arguments['--debug']
 log = arguments['--log']
+metrics = ('{log}/robot_leaderboard.prom'.format(log=log)
+           if arguments['--metrics'] and log else None)
+poolSize = int(arguments['--pool-size'])
+timeout = float(arguments['--timeout'])
 threshold = float(arguments['--levenshtein'])
 videos = arguments['<videos.lst>']
+cacheDir = arguments['--cache-dir']
+workers = int(arguments['--workers'])
 
 logger = create_logger('robot_leaderboard', path=log, debug=debug)
+profiler = create_profiler(
+    'robot_leaderboard', path=log, enabled=arguments['--profile'],
+    cprofile=arguments['--cprofile'])
 robot = RobotCamomile(
-    url, 'robot_leaderboard', password=password, period=period, logger=logger)
+    url, 'robot_leaderboard', password=password, period=period, logger=logger,
+    cache_dir=cacheDir, pool_size=poolSize, timeout=timeout, metrics=metrics)
 
 # test corpus
 test = robot.getCorpusByName('mediaeval.test')
@@ -154,11 +174,14 @@ for team, team_name in teams.iteritems():
 
 while True:
 
+    profiler.phase('load consensus')
+
     qRelevant = {}
     shots = set([])
 
-    for medium in media:
-        for annotation in robot.getAnnotations(refLayer, medium=medium):
+    for _, annotations in robot.getAnnotations_iter(
+            refLayer, media=media, workers=workers, ordered=False):
+        for annotation in annotations:
 
             shot = annotation.fragment
             shots.add(shot)
@@ -188,6 +211,7 @@ while True:
     meanAveragePrecision = {}
 
     # evaluate every original submissions
+    profiler.phase('evaluate')
     for layer in robot.getLayers(
             test, data_type='mediaeval.persondiscovery.label'):
 
@@ -208,11 +232,12 @@ while True:
 
         # evaluate this submission and store MAP value
         mAP = computeMeanAveragePrecision(
-            robot, layer._id, media, shots, qRelevant)
+            robot, layer._id, media, shots, qRelevant, workers=workers)
 
         meanAveragePrecision.setdefault(teamID, {})[runName] = mAP
 
     # rank all submissions based on their MAP
+    profiler.phase('update leaderboard')
     ranking = set([])
     for teamID, runs in meanAveragePrecision.iteritems():
         teamName = teams[teamID]
@@ -270,5 +295,8 @@ while True:
 
         robot.updateLayer(leaderboard[myTeamID], description=description)
 
+    profiler.summary()
+    robot.exportMetrics()
+
     logger.info("waiting for {period}s".format(period=period))
     sleep(period)
@@ -47,12 +47,19 @@ Options:
   --multiple=N             Number of mugshot in animation [default: 5].
   --period=N               Update mugshot every N sec [default: 10800].
   --log=DIR                Path to log directory.
+  --metrics                Export Camomile API metrics to log directory.
+  --profile                Log per-cycle timing of each phase.
+  --cprofile               Dump cProfile stats of the main thread to log
+                           directory.
+  --pool-size=N            HTTP connection pool size [default: 10].
+  --timeout=N              HTTP request timeout in seconds [default: 300].
+  --cache-dir=DIR          Path to local annotation mirror.
 
 """
 
 from common import RobotCamomile
 from common import HTMLTime
-from common import create_logger
+from common import create_logger, create_profiler
 from docopt import docopt
 import cv
 import cv2
@@ -74,11 +81,20 @@ period = int(arguments['--period'])
 
 debug = arguments['--debug']
 log = arguments['--log']
+metrics = ('{log}/robot_mugshot.prom'.format(log=log)
+           if arguments['--metrics'] and log else None)
+poolSize = int(arguments['--pool-size'])
+timeout = float(arguments['--timeout'])
+cacheDir = arguments['--cache-dir']
 logger = create_logger('robot_mugshot', path=log, debug=debug)
+profiler = create_profiler(
+    'robot_mugshot', path=log, enabled=arguments['--profile'],
+    cprofile=arguments['--cprofile'])
 
 robot = RobotCamomile(
     url, 'robot_evidence', password=password,
-    period=period, logger=logger)
+    period=period, logger=logger, cache_dir=cacheDir,
+    pool_size=poolSize, timeout=timeout, metrics=metrics)
 
 # unique layer containing manual annotations
 test = robot.getCorpusByName('mediaeval.test')
@@ -103,6 +119,7 @@ HEIGHT = 288
 
 while True:
 
+    profiler.phase('collect evidences')
     logger.info('collecting evidences')
 
     # loop on evidences, medium by medium
@@ -141,12 +158,14 @@ while True:
         for T in sorted(mediumEvidence[medium]):
 
             # read frame by frame until we reach time T
+            profiler.phase('decode')
             while t < T:
                 _, frame = capture.read()
                 frameNumber = int(capture.get(cv.CV_CAP_PROP_POS_FRAMES))
                 t = htmlTime(frameNumber)
 
             # DAR/PAR mismatch
+            profiler.phase('crop')
             resized = cv2.resize(frame, (WIDTH, HEIGHT))
 
             # extract mugshot as PNG data
@@ -158,6 +177,7 @@ while True:
                 # maintain the set of all mugshots as a list of numpy array
                 pngs.setdefault(person_name, []).append((mugshot, medium))
 
+    profiler.phase('upload')
     logger.info('saving mugshots')
 
     for person_name, mugshots in pngs.iteritems():
@@ -216,5 +236,8 @@ while True:
     # update the layer description once and for all
     robot.updateLayer(mugshotLayerID, description=mugshotLayer.description)
 
+    profiler.summary()
+    robot.exportMetrics()
+
     logger.info('waiting for {period:d} seconds'.format(period=period))
     time.sleep(period)
@@ -42,11 +42,24 @@ Options:
                            [default: http://api.mediaeval.niderb.fr]
   --password=P45sw0Rd      Password.
   --period=N               Query queue every N seconds [default: 600].
+  --batch=N                Dequeue up to N items at once [default: 1].
+  --min-wait=N             When queue is empty, wait N sec then twice as
+                           long, up to --period sec [default: 0.5].
   --log=DIR                Path to log directory.
+  --metrics                Export Camomile API metrics to log directory.
+  --profile                Log per-cycle timing of each phase.
+  --cprofile               Dump cProfile stats of the main thread to log
+                           directory.
+  --pool-size=N            HTTP connection pool size [default: 10].
+  --timeout=N              HTTP request timeout in seconds [default: 300].
+  --workers=N              Number of media read in parallel [default: 4].
+  --chunk=N                Copy annotations by chunks of N [default: 1000].
+  --attempts=N             Give up copying a submission (and remove its
+                           partial copy) after N failures [default: 3].
 
 """
 
-from common import RobotCamomile, create_logger
+from common import RobotCamomile, create_logger, create_profiler
 from docopt import docopt
 
 arguments = docopt(__doc__, version='0.1')
@@ -54,28 +67,154 @@ arguments = docopt(__doc__, version='0.1')
 url = arguments['--url']
 password = arguments['--password']
 period = int(arguments['--period'])
+batch = int(arguments['--batch'])
+minWait = float(arguments['--min-wait'])
+workers = int(arguments['--workers'])
+chunk = int(arguments['--chunk'])
+attempts = int(arguments['--attempts'])
 
 debug = arguments['--debug']
 log = arguments['--log']
+metrics = ('{log}/robot_submission.prom'.format(log=log)
+           if arguments['--metrics'] and log else None)
+poolSize = int(arguments['--pool-size'])
+timeout = float(arguments['--timeout'])
 logger = create_logger('robot_submission', path=log, debug=debug)
+profiler = create_profiler(
+    'robot_submission', path=log, enabled=arguments['--profile'],
+    cprofile=arguments['--cprofile'],
+    interval=period)
 
 robot = RobotCamomile(
     url, 'robot_submission', password=password,
-    period=period, logger=logger)
+    period=period, logger=logger,
+    pool_size=poolSize, timeout=timeout, metrics=metrics)
 
 submissionQueue = robot.getQueueByName('mediaeval.submission.in')
 testCorpus = robot.getCorpusByName('mediaeval.test')
 robot_evidence = robot.getUserByName('robot_evidence')
 robot_label = robot.getUserByName('robot_label')
 
+
+def getCopies():
+
+    # original layer --> its (possibly partial) copy
+    copies = {}
+    for dataType in ['mediaeval.persondiscovery.evidence',
+                     'mediaeval.persondiscovery.label']:
+        for layer in robot.getLayers(testCorpus, data_type=dataType):
+            # HACK - description might be u''
+            if layer.description and 'copy' in layer.description:
+                copies[layer.description.copy] = layer
+    return copies
+
+
+def isComplete(evidence, label):
+
+    # both layers were completely copied and cross-referenced
+    return (evidence is not None and label is not None and
+            'copying' not in evidence.description and
+            'copying' not in label.description and
+            'id_label' in evidence.description and
+            'id_evidence' in label.description)
+
+
+def copyLayer(layer, copies):
+
+    # (in)complete copy of this layer
+    copy = copies.get(layer, None)
+    if copy is not None and 'copying' not in copy.description:
+        return copy
+
+    # resumes interrupted copy, if any
+    return robot.duplicate_layer(layer, returns_id=False,
+                                 workers=workers, chunk=chunk)
+
+
+def copySubmission(id_evidence, id_label):
+
+    copies = getCopies()
+
+    # duplicate evidence layer
+    profiler.phase('copy evidence')
+    evidence = copyLayer(id_evidence, copies)
+
+    # duplicate label layer
+    profiler.phase('copy label')
+    label = copyLayer(id_label, copies)
+
+    # update evidence --> label cross-reference
+    profiler.phase('permissions')
+    evidence.description.id_label = label._id
+    robot.updateLayer(evidence._id, description=evidence.description)
+
+    # update label --> evidence cross-reference
+    label.description.id_evidence = evidence._id
+    robot.updateLayer(label._id, description=label.description)
+
+    # give ADMIN permission to robot_evidence
+    robot.setLayerPermissions(evidence._id, robot.ADMIN, user=robot_evidence)
+
+    # give READ permission to robot_label
+    robot.setLayerPermissions(label._id, robot.READ, user=robot_label)
+
+    # give ADMIN permission to robot_evidence
+    # (allowing to later update the mapping)
+    robot.setLayerPermissions(label._id, robot.ADMIN, user=robot_evidence)
+
+
+def removeCopies(id_evidence, id_label):
+
+    copies = getCopies()
+    for layer in [id_evidence, id_label]:
+        if layer in copies:
+            robot.deleteLayer(copies[layer]._id)
+
+
+# resume submissions whose copy was interrupted (e.g. by a crash)
+copies = getCopies()
+for labelLayer in robot.getLayers(
+        testCorpus, data_type='mediaeval.persondiscovery.label'):
+
+    # we are only looking for original submissions (not copies)
+    description = labelLayer.description
+    if not description or 'copy' in description:
+        continue
+
+    id_label = labelLayer._id
+    id_evidence = description.get('id_evidence', None)
+    evidence = copies.get(id_evidence, None)
+    label = copies.get(id_label, None)
+
+    # not copied yet (still in queue) or completely copied
+    if evidence is None and label is None:
+        continue
+    if isComplete(evidence, label):
+        continue
+
+    logger.info("resume - {evidence:s}.{label:s}".format(
+        evidence=id_evidence, label=id_label))
+    try:
+        copySubmission(id_evidence, id_label)
+    except Exception:
+        # left as is, to be resumed next time
+        logger.error(
+            "error when resuming the copy of {evidence:s}.{label:s}".format(
+                evidence=id_evidence, label=id_label))
+
 # forever loop on submission queue
-for item in robot.dequeue_loop(submissionQueue):
+for item in profiler.cycles(robot.dequeue_loop(submissionQueue,
+                                               batch=batch,
+                                               min_wait=minWait),
+                            'dequeue'):
 
     id_evidence = item.id_evidence
     id_label = item.id_label
 
     # withdrawn submission
     if hasattr(item, 'deletedBy'):
+
+        profiler.phase('delete')
         logger.info(
             "del - {team:s}.{user:s} - {evidence:s}.{label:s}".format(
                 team=item.team, user=item.user,
@@ -116,42 +255,26 @@ for item in robot.dequeue_loop(submissionQueue):
             team=item.team, user=item.user, name=item.name,
             evidence=id_evidence, label=id_label))
 
-    # duplicate evidence layer
+    # in a try/except scope because layers might have been deleted by now
     try:
-        # in a try/except scope because it might have been deleted by now
-        evidence = robot.duplicate_layer(id_evidence, returns_id=False)
-    except Exception:
-        logger.error(
-            "error when create the copy of {evidence:s} ".format(
-                evidence=id_evidence))        
-        continue
+        copySubmission(id_evidence, id_label)
 
-    # duplicate label layer
-    try:
-        # in a try/except scope because it might have been deleted by now
-        label = robot.duplicate_layer(id_label, returns_id=False)
     except Exception:
-        robot.deleteLayer(evidence._id)
-        logger.error(
-            """error when create the copy of {label:s}, 
-               remove the copy of {evidence:s}""".format(
-            label=id_label, evidence=id_evidence))        
-        continue
-
-    # update evidence --> label cross-reference
-    evidence.description.id_label = label._id
-    robot.updateLayer(evidence._id, description=evidence.description)
 
-    # update label --> evidence cross-reference
-    label.description.id_evidence = evidence._id
-    robot.updateLayer(label._id, description=label.description)
+        # try again later (resuming the partial copy)...
+        failures = item.get('failures', 0) + 1
+        if failures < attempts:
+            logger.error(
+                "error when copying {evidence:s}.{label:s} "
+                "(attempt #{n:d})".format(
+                    evidence=id_evidence, label=id_label, n=failures))
+            item['failures'] = failures
+            robot.enqueue(submissionQueue, item)
+            continue
 
-    # give ADMIN permission to robot_evidence
-    robot.setLayerPermissions(evidence._id, robot.ADMIN, user=robot_evidence)
-
-    # give READ permission to robot_label
-    robot.setLayerPermissions(label._id, robot.READ, user=robot_label)
-
-    # give ADMIN permission to robot_evidence
-    # (allowing to later update the mapping)
-    robot.setLayerPermissions(label._id, robot.ADMIN, user=robot_evidence)
+        # ... or give up and remove partial copies
+        logger.error(
+            "error when copying {evidence:s}.{label:s}, "
+            "remove its partial copy".format(
+                evidence=id_evidence, label=id_label))
+        removeCopies(id_evidence, id_label)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 CNRS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""Shot-level data structures used by robot_label_in"""
+
+from collections import Counter
+from itertools import count
+import heapq
+import threading
+
+
+class ShotAnnotationStore(object):
+    """Label annotations of one medium, indexed by shot
+
+    >>> store = ShotAnnotationStore(annotations)
+    >>> store.annotations(shot)  # list of annotations of this shot
+    >>> store.annotators(shot)   # set of users who already annotated it
+    >>> store.known(shot)        # set of person names already annotated
+    >>> store.shots_with(name)   # set of shots where name was annotated
+
+    The index is built in one pass over the annotations.
+    """
+
+    EMPTY = frozenset()
+
+    def __init__(self, annotations):
+        super(ShotAnnotationStore, self).__init__()
+
+        self._annotations = {}
+        self._annotators = {}
+        self._known = {}
+        self._shotsWith = {}
+
+        for annotation in annotations:
+            shot = annotation.fragment
+            data = annotation.data
+
+            self._annotations.setdefault(shot, []).append(annotation)
+            self._annotators.setdefault(shot, set()).add(data.annotator)
+            for name in data.get('known', {}):
+                self._known.setdefault(shot, set()).add(name)
+                self._shotsWith.setdefault(name, set()).add(shot)
+
+    def __contains__(self, shot):
+        return shot in self._annotations
+
+    def __len__(self):
+        return len(self._annotations)
+
+    def shots(self):
+        return self._annotations.keys()
+
+    def annotations(self, shot):
+        return self._annotations.get(shot, [])
+
+    def annotators(self, shot):
+        return self._annotators.get(shot, self.EMPTY)
+
+    def known(self, shot):
+        return self._known.get(shot, self.EMPTY)
+
+    def shots_with(self, name):
+        return self._shotsWith.get(name, self.EMPTY)
+
+
+class NameIndex(object):
+    """Interned person names, for sets of names stored as sets of IDs
+
+    >>> names = NameIndex()
+    >>> ids = names.ids(['john_doe', 'jane_doe'])
+    >>> ids |= names.ids(['foo'])         # union
+    >>> ids -= names.ids(['bar'])         # difference
+    >>> names.names(ids)                  # back to list of names
+
+    Each name gets a small integer ID the first time it is seen, and a
+    set of names is a frozenset of their IDs. The same int object is
+    returned for a given name, so it is shared by all sets containing it
+    (rather than each set keeping its own copy of the name).
+    """
+
+    EMPTY = frozenset()
+
+    def __init__(self):
+        super(NameIndex, self).__init__()
+        self._ids = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def id(self, name):
+        try:
+            return self._ids[name]
+        except KeyError:
+            with self._lock:
+                if name not in self._ids:
+                    self._ids[name] = len(self._names)
+                    self._names.append(name)
+                return self._ids[name]
+
+    def ids(self, names):
+        return frozenset(self.id(name) for name in names)
+
+    def names(self, ids):
+        return [self._names[i] for i in sorted(ids)]
+
+
+def sliding_window_union(sortedShots, names, before, after):
+    """Union of names over a sliding window of neighbouring shots
+
+    Yields (shot, window) for every shot of `sortedShots` (chronologically
+    sorted), where `window` is the union of the sets of name IDs `names(s)`
+    over the shots s in sortedShots[max(i - before, 0):min(i + after, n)].
+
+    Name IDs are counted in a multiset updated as the window slides, so all
+    windows are produced in one linear sweep whatever its width.
+    """
+
+    n = len(sortedShots)
+    shotNames = [names(shot) for shot in sortedShots]
+
+    counts = Counter()
+    lo, hi = 0, 0
+
+    for i, shot in enumerate(sortedShots):
+
+        # extend window on the right
+        while hi < min(i + after, n):
+            counts.update(shotNames[hi])
+            hi += 1
+
+        # shrink window on the left
+        while lo < max(i - before, 0):
+            for name in shotNames[lo]:
+                counts[name] -= 1
+                if counts[name] == 0:
+                    del counts[name]
+            lo += 1
+
+        yield shot, frozenset(counts)
+
+
+class ShotScheduler(object):
+    """Pending shots of all media, popped best-first
+
+    >>> scheduler = ShotScheduler(load)
+    >>> scheduler.update(medium, [(rank, shot), ...])
+    >>> for item in scheduler.pop(n):  # n items with lowest rank
+    ...     pass
+
+    Updating a medium replaces all its pending shots. Shots with the same
+    rank are popped in the order they were added. Only ranks and shot IDs
+    are kept: items are built by `load(medium, shot)` as they are popped,
+    and shots for which it returns None are skipped.
+    """
+
+    def __init__(self, load):
+        super(ShotScheduler, self).__init__()
+        self.load = load
+        self._heap = []
+        self._version = {}
+        self._pending = {}
+        self._counter = count()
+
+    def __len__(self):
+        return sum(self._pending.itervalues())
+
+    def update(self, medium, shots):
+        """Replace pending shots of `medium`; returns their number"""
+
+        # previous entries of this medium are now stale
+        version = self._version.get(medium, 0) + 1
+        self._version[medium] = version
+
+        n = 0
+        for rank, shot in shots:
+            heapq.heappush(self._heap, (
+                rank, next(self._counter), medium, version, shot))
+            n += 1
+        self._pending[medium] = n
+
+        # get rid of stale entries once they outnumber pending ones
+        if len(self._heap) > 2 * len(self) + 1000:
+            self._heap = [entry for entry in self._heap
+                          if entry[3] == self._version[entry[2]]]
+            heapq.heapify(self._heap)
+
+        return n
+
+    def pop(self, n):
+        """Iterate over (at most) `n` pending shots, best first"""
+
+        while n > 0 and self._heap:
+            _, _, medium, version, shot = heapq.heappop(self._heap)
+            if version != self._version[medium]:
+                continue
+            self._pending[medium] -= 1
+            item = self.load(medium, shot)
+            if item is None:
+                continue
+            n -= 1
+            yield item